@@ -3,7 +3,15 @@ from flask_cors import CORS
 from dotenv import load_dotenv, find_dotenv
 
 from .extensions import db, ma
-from .commands import create_tables
+from .commands import (
+    create_tables,
+    upgrade_db,
+    backfill_comment_messages,
+    run_worker,
+    run_scheduler,
+    bench_parsers,
+    bench_cli,
+)
 from .routes.api import api as api_bp
 from .routes.posts import posts as posts_bp
 from .routes.comments import comments as comments_bp
@@ -24,6 +32,12 @@ def create_app(config_file="settings.py"):
     app.register_blueprint(comments_bp, url_prefix="/api/comments")
 
     app.cli.add_command(create_tables)
+    app.cli.add_command(upgrade_db)
+    app.cli.add_command(backfill_comment_messages)
+    app.cli.add_command(run_worker)
+    app.cli.add_command(run_scheduler)
+    app.cli.add_command(bench_parsers)
+    app.cli.add_command(bench_cli)
 
     return app
 
@@ -0,0 +1,291 @@
+import os
+import random
+from datetime import datetime, timedelta
+from functools import lru_cache
+from html import escape
+
+from ..scrape.cache import normalize_url
+from ..scrape.client import fetch
+
+# deterministic stand-in for geekhack pages, shaped like the smf markup the scrapers read
+# board rows, opening posts with images/imgur albums,
+# and comment pages with nested quotes and attachments
+BASE_TIME = datetime(2024, 6, 1, 12, 0, 0)
+DATE_FORMAT = "%a, %d %B %Y, %H:%M:%S"
+BOARD_PAGES = {132: 6, 70: 4}
+BOARD_TOPIC_BASE = {132: 200000, 70: 100000}
+USERS = ["alice", "bob", "keycap_kid", "thock lord", "lubed", "gb_runner", "zealio"]
+# topics past this id are off-board threads with exactly (topic_id - LONG_THREAD_BASE) replies,
+# used to measure memory while syncing threads of any length
+LONG_THREAD_BASE = 900000
+WORDS = "gmk set kit alpha novelty spacebar render sample proxy mx spring lube stab tray".split()
+
+
+def topic_rng(topic_id):
+    return random.Random(topic_id)
+
+
+def topic_board(topic_id):
+    for board, base in BOARD_TOPIC_BASE.items():
+        if base <= topic_id < base + BOARD_PAGES[board] * 50:
+            return board, topic_id - base
+    return None, None
+
+
+def topic_last_updated(topic_id):
+    board, position = topic_board(topic_id)
+    return BASE_TIME - timedelta(hours=position or 0, minutes=board or 0)
+
+
+def long_thread(replies):
+    return LONG_THREAD_BASE + replies
+
+
+def topic_replies(topic_id):
+    if topic_id >= LONG_THREAD_BASE:
+        return topic_id - LONG_THREAD_BASE
+    rng = topic_rng(topic_id)
+    # mostly short threads with a few very long group buys
+    if rng.random() < 0.1:
+        return rng.randint(300, 1500)
+    return rng.randint(0, 120)
+
+
+def topic_last_page_count(topic_id):
+    return (topic_replies(topic_id) // 50) * 50
+
+
+def sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def topic_title(topic_id):
+    return f"[GB] {sentence(random.Random(-topic_id), 3).title()}"
+
+
+def pagelinks(query, offset, last_offset):
+    links = []
+    for page_offset in range(0, last_offset + 1, 50):
+        if page_offset == offset:
+            links.append(f"[<strong>{page_offset // 50 + 1}</strong>]")
+        else:
+            url = f"https://geekhack.org/index.php?{query}.{page_offset}"
+            links.append(
+                f'<a class="navPages" href="{url}">{page_offset // 50 + 1}</a>'
+            )
+    if last_offset > 0:
+        url = f"https://geekhack.org/index.php?{query}.{min(offset + 50, last_offset)}"
+        links.append(f'<a class="navPages" href="{url}">&#187;</a>')
+    return f'<div class="pagelinks floatleft">Pages: {" ".join(links)}</div>'
+
+
+def page(body):
+    head = (
+        '<div id="header"><div class="user"><ul class="reset">'
+        '<li class="greeting">Hello guest</li></ul></div></div>'
+    )
+    return (
+        "<!DOCTYPE html><html><head><title>geekhack</title></head>"
+        f"<body>{head}{body}</body></html>"
+    ).encode()
+
+
+def board_row(topic_id, sticky=False):
+    rng = topic_rng(topic_id)
+    bg = "stickybg" if sticky else "windowbg"
+    title = escape(topic_title(topic_id))
+    last_updated = topic_last_updated(topic_id).strftime(DATE_FORMAT)
+    icon = "https://cdn.geekhack.org/Themes/default/images/topic/veryhot_post.gif"
+    url = (
+        "https://geekhack.org/index.php?PHPSESSID=5d41402abc4b2a76b9719d911017c592"
+        f"&amp;topic={topic_id}.0"
+    )
+    return (
+        f'<tr><td class="icon1 {bg}"><img src="{icon}" alt="" /></td>'
+        f'<td class="subject {bg}2"><div>'
+        f'<span id="msg_{topic_id * 7}"><a href="{url}">{title}</a></span>'
+        f'<p>Started by <a href="#">{escape(rng.choice(USERS))}</a></p></div></td>'
+        f'<td class="stats {bg}">{topic_replies(topic_id)} Replies<br />'
+        f"{rng.randint(100, 90000)} Views</td>"
+        f'<td class="lastpost {bg}"><a href="#">'
+        '<img src="https://cdn.geekhack.org/last_post.gif" alt="Last post" /></a>'
+        f"\n\t\t\t\t\t\t{last_updated}<br />"
+        f'\n\t\t\t\t\t\tby <a href="#">{escape(rng.choice(USERS))}</a></td></tr>'
+    )
+
+
+# pages are generated once, so serving them costs the benchmarked process as little as possible
+@lru_cache(maxsize=1024)
+def board_page(board, offset):
+    base = BOARD_TOPIC_BASE[board]
+    rows = []
+    if offset == 0:
+        # stickies sit above the regular rows and are skipped by the board scrapers
+        rows.extend(board_row(base - 1 - i, sticky=True) for i in range(2))
+    first = offset
+    last = min(offset + 50, BOARD_PAGES[board] * 50)
+    rows.extend(board_row(base + position) for position in range(first, last))
+    body = (
+        pagelinks(f"board={board}", offset, (BOARD_PAGES[board] - 1) * 50)
+        + '<table class="table_grid"><thead><tr><th>Subject</th></tr></thead><tbody>'
+        + "".join(rows)
+        + '</tbody><tbody><tr class="whos_viewing">'
+        + '<td colspan="4">3 guests are viewing this board.</td></tr></tbody></table>'
+    )
+    return page(body)
+
+
+def quote(rng, depth):
+    commenter = rng.choice(USERS)
+    date = (BASE_TIME - timedelta(days=rng.randint(1, 400))).strftime(DATE_FORMAT)
+    inner = escape(sentence(rng))
+    if depth > 1:
+        inner = quote(rng, depth - 1) + inner
+    return (
+        '<div class="quoteheader"><div class="topslice_quote">'
+        f'<a href="#">Quote from: {commenter} on {date}</a></div></div>'
+        f'<blockquote class="bbc_standard_quote">{inner}<br /></blockquote>'
+        '<div class="quotefooter"><div class="botslice_quote"></div></div>'
+    )
+
+
+def post_wrapper(topic_id, number, rng, opening=False):
+    commenter = escape(rng.choice(USERS))
+    # replies 17 minutes apart, the last one at the time the board row shows as the last post
+    created = topic_last_updated(topic_id) - timedelta(
+        minutes=(topic_replies(topic_id) - number) * 17
+    )
+    # kept within a postgres integer for threads of up to 20000 replies
+    message_id = topic_id % 100000 * 20000 + number
+    if opening:
+        key_text = f"&#171; <strong>on:</strong> {created.strftime(DATE_FORMAT)} &#187;"
+    else:
+        key_text = (
+            f"&#171; <strong>Reply #{number} on:</strong> "
+            f"{created.strftime(DATE_FORMAT)} &#187;"
+        )
+
+    content = []
+    if not opening and rng.random() < 0.4:
+        content.append(quote(rng, rng.randint(1, 4)))
+    content.append(escape(sentence(rng, rng.randint(5, 40))))
+    if opening:
+        for i in range(rng.randint(2, 12)):
+            content.append(
+                f'<br /><img src="https://i.imgur.com/{topic_id}{i}.png" alt="" class="bbc_img" />'
+            )
+        content.append(
+            f'<br /><img src="https://cdn.geekhack.org/Smileys/default/smiley.gif" alt=":)" />'
+        )
+        content.append(
+            f'<br /><a href="https://imgur.com/a/alb{topic_id % 40}" class="bbc_link">album</a>'
+        )
+    elif rng.random() < 0.2:
+        content.append(
+            f'<br /><a href="https://example.com/{rng.randint(1, 999)}" class="bbc_link">link</a>'
+        )
+
+    attachments = ""
+    if not opening and rng.random() < 0.1:
+        url = (
+            "https://geekhack.org/index.php"
+            f"?action=dlattach;topic={topic_id}.0;attach={message_id}"
+        )
+        attachments = (
+            f'<div class="attachments"><div><a href="{url}">'
+            f'<img src="{url};image" alt="" /></a></div></div>'
+        )
+
+    starter = (
+        '<li class="threadstarter">Thread Starter</li>'
+        if opening or rng.random() < 0.05
+        else ""
+    )
+    subject = topic_title(topic_id) if opening else f"Re: {topic_title(topic_id)}"
+    windowbg = "windowbg" if number % 2 == 0 else "windowbg2"
+    return (
+        f'<div class="{windowbg}"><span class="topslice"><span></span></span>'
+        '<div class="post_wrapper">'
+        f'<div class="poster"><h4>\n\t\t\t\t\t\t\t{commenter}\n\t\t\t\t\t\t</h4>'
+        f'<ul class="reset smalltext">{starter}'
+        f'<li class="postcount">Posts: {rng.randint(1, 9000)}</li></ul></div>'
+        '<div class="postarea"><div class="flow_hidden">'
+        '<div class="keyinfo"><div class="messageicon"></div>'
+        f'<h5 id="subject_{message_id}"><a href="#">{escape(subject)}</a></h5>'
+        f'<div class="smalltext">{key_text}</div></div></div>'
+        f'<div class="post"><div class="inner" id="msg_{message_id}">'
+        f'{"".join(content)}</div></div></div>'
+        f"{attachments}</div></div>"
+    )
+
+
+@lru_cache(maxsize=1024)
+def topic_page(topic_id, offset):
+    replies = topic_replies(topic_id)
+    last_page_count = topic_last_page_count(topic_id)
+    wrappers = []
+    for number in range(offset, min(offset + 50, replies + 1)):
+        rng = random.Random(topic_id * 100000 + number)
+        wrappers.append(post_wrapper(topic_id, number, rng, opening=number == 0))
+    body = (
+        pagelinks(f"topic={topic_id}", offset, last_page_count)
+        + '<div id="forumposts">'
+        + "".join(wrappers)
+        + "</div>"
+    )
+    return page(body)
+
+
+def album_images(album_hash):
+    rng = random.Random(album_hash)
+    return [
+        f"https://i.imgur.com/{album_hash}{i}.jpg" for i in range(rng.randint(1, 8))
+    ]
+
+
+def corpus_path(directory, url):
+    key = normalize_url(url).split("?", 1)[-1].replace("/", "_")
+    return os.path.join(directory, f"{key}.html")
+
+
+def record(urls, directory):
+    """
+    Save live pages into a corpus directory,
+    where the stand-in server prefers them over synthetic ones
+    """
+    os.makedirs(directory, exist_ok=True)
+    for url in urls:
+        path = corpus_path(directory, url)
+        with open(path, "wb") as f:
+            f.write(fetch(url).content)
+        print(f"recorded {url} -> {path}")
+
+
+def build(directory, topics=10):
+    """
+    Materialize synthetic pages into a corpus directory:
+    every board page plus the pages of a few topics
+    """
+    os.makedirs(directory, exist_ok=True)
+    urls = []
+    for board, pages in BOARD_PAGES.items():
+        for offset in range(0, pages * 50, 50):
+            urls.append(
+                (
+                    f"https://geekhack.org/index.php?board={board}.{offset}",
+                    board_page(board, offset),
+                )
+            )
+    deepest = sorted(range(200000, 200000 + 300), key=topic_replies, reverse=True)
+    for topic_id in deepest[:topics]:
+        for offset in range(0, topic_last_page_count(topic_id) + 1, 50):
+            urls.append(
+                (
+                    f"https://geekhack.org/index.php?topic={topic_id}.{offset}",
+                    topic_page(topic_id, offset),
+                )
+            )
+    for url, markup in urls:
+        with open(corpus_path(directory, url), "wb") as f:
+            f.write(markup)
+    return len(urls)
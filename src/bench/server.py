@@ -0,0 +1,124 @@
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+from ..scrape.client import GEEKHACK_ORIGIN
+from . import corpus
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves geekhack board and topic pages plus the imgur album api from the corpus
+    Recorded pages in the corpus directory win over synthetic ones
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency * random.uniform(0.5, 1.5))
+        if server.error_rate and random.random() < server.error_rate:
+            self.respond(
+                server.error_status, b"stand-in error", headers={"Retry-After": "0"}
+            )
+            return
+
+        parts = urlsplit(self.path)
+        if parts.path.startswith("/3/album/"):
+            album_hash = parts.path.split("/")[3]
+            with server.served_lock:
+                server.album_requests[album_hash] = (
+                    server.album_requests.get(album_hash, 0) + 1
+                )
+            images = [{"link": link} for link in corpus.album_images(album_hash)]
+            self.respond(200, json.dumps({"data": images}).encode(), "application/json")
+            return
+
+        body = self.page(parts.query)
+        if body is None:
+            self.respond(404, b"not found")
+        else:
+            self.respond(200, body)
+            with server.served_lock:
+                server.served += 1
+
+    def page(self, query):
+        if self.server.corpus_dir:
+            path = corpus.corpus_path(
+                self.server.corpus_dir, f"{GEEKHACK_ORIGIN}/index.php?{query}"
+            )
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    return f.read()
+
+        params = dict(parse_qsl(query))
+        try:
+            if "board" in params:
+                board, offset = (int(part) for part in params["board"].split("."))
+                if board in corpus.BOARD_PAGES:
+                    return corpus.board_page(board, offset)
+            elif "topic" in params:
+                topic_id, offset = (int(part) for part in params["topic"].split("."))
+                return corpus.topic_page(topic_id, offset)
+        except ValueError:
+            pass
+        return None
+
+    def respond(
+        self, status, body, content_type="text/html; charset=UTF-8", headers=None
+    ):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        corpus_dir=None,
+        latency=0.0,
+        error_rate=0.0,
+        error_status=500,
+        verbose=False,
+    ):
+        super().__init__(address, StandInHandler)
+        self.corpus_dir = corpus_dir
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.verbose = verbose
+        # geekhack pages served successfully, what the benchmarks count as pages fetched
+        self.served = 0
+        # imgur album api requests per album hash
+        self.album_requests = {}
+        self.served_lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_server(host="127.0.0.1", port=0, **options):
+    """
+    Run a stand-in server on a background thread and return it, port 0 picks a free port
+    """
+    server = StandInServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
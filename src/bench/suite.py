@@ -0,0 +1,387 @@
+import gc
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout, nullcontext
+
+from flask import Flask
+from sqlalchemy.engine import make_url
+
+from ..scrape import cache, client, imgur, parser, ratelimit
+from ..scrape.client import fetch, map_concurrently
+from ..scrape.comments import parse_page_comments, scrape_page_comments
+from ..scrape.crawl import crawl_scope
+from ..scrape.posts import (
+    board_url,
+    find_topic_on_board_page,
+    get_all_post_data,
+    get_page_posts_small_data,
+    get_post_data,
+    get_posts_data,
+    parse_page_posts_small_data,
+    parse_post_data,
+)
+from . import corpus
+
+BENCHES = [
+    "get_page_posts_small_data",
+    "get_post_data",
+    "scrape_page_comments",
+    "update",
+    "process_post_comments",
+    "long_thread",
+]
+# these truncate and write to the database, so they only run against a separate scratch one
+DB_BENCHES = ["update", "process_post_comments", "long_thread"]
+
+
+class Counter:
+    """
+    Stand-in for a job's progress, counts what crawl_board reports
+    """
+
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + (value or 0)
+
+
+def configure(server, backend=None, processes=0, rate=1000.0, use_cache=False):
+    """
+    Point the scrapers at the stand-in server, with a throwaway cache and rate limiter state
+    """
+    scratch = tempfile.mkdtemp(prefix="keytonomy-bench-")
+    client.GEEKHACK_URL = server.url
+    imgur.IMGUR_API_URL = f"{server.url}/3"
+    imgur.IMGUR_CACHE_DIR = os.path.join(scratch, "imgur")
+    os.environ.setdefault("IMGUR_CLIENT_ID", "bench")
+    cache.CACHE_ENABLED = use_cache
+    cache.CACHE_DIR = os.path.join(scratch, "cache")
+    ratelimit.RATE_LIMIT_DIR = os.path.join(scratch, "ratelimit")
+    ratelimit.RATE = rate
+    ratelimit.BURST = max(ratelimit.BURST, rate)
+    if backend:
+        parser.PARSER = backend
+        # spawned parse processes read the backend from the environment
+        os.environ["SCRAPE_PARSER"] = backend
+        parser.resolve_backend.cache_clear()
+    parser.PARSE_PROCESSES = processes
+    return scratch
+
+
+def same_database(url, other):
+    """
+    Whether two database urls reach the same database, whatever user they connect as
+    """
+    url, other = (
+        make_url(u.replace("postgres://", "postgresql://", 1)) for u in (url, other)
+    )
+    return (url.host, url.port or 5432, url.database) == (
+        other.host,
+        other.port or 5432,
+        other.database,
+    )
+
+
+def database_app(url):
+    """
+    A bare app bound to the scratch database, with the schema created or upgraded
+    """
+    from ..extensions import db
+    from ..migrations import upgrade
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = url.replace(
+        "postgres://", "postgresql://", 1
+    )
+    db.init_app(app)
+    with app.app_context():
+        upgrade()
+    return app
+
+
+def measure(name, run, parse=None, server=None, setup=None):
+    """
+    Time run(), run it again under tracemalloc for its peak memory,
+    then time parse() alone on already fetched markup
+    run returns the number of pages it handled, parse the number of pages it parsed
+    setup, when given, resets the state run changes before each of the two runs
+    tracemalloc slows everything it traces down several times, so it is kept out of the timed run
+    """
+    if setup is not None:
+        setup()
+    gc.collect()
+    served = server.served if server is not None else 0
+    start = time.perf_counter()
+    with crawl_scope():
+        pages = run()
+    seconds = time.perf_counter() - start
+    if server is not None:
+        # count what was actually fetched, memoized pages excluded
+        pages = server.served - served
+
+    if setup is not None:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    with crawl_scope():
+        run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    parse_ms = None
+    if parse is not None:
+        start = time.perf_counter()
+        parsed = parse()
+        parse_ms = (time.perf_counter() - start) * 1000 / max(parsed, 1)
+
+    return {
+        "name": name,
+        "pages": pages,
+        "seconds": seconds,
+        "pages_per_sec": pages / seconds if seconds else 0,
+        "parse_ms": parse_ms,
+        "peak_mb": peak / (1024 * 1024),
+    }
+
+
+def board_urls():
+    return [
+        board_url(board, offset)
+        for board, pages in corpus.BOARD_PAGES.items()
+        for offset in range(0, pages * 50, 50)
+    ]
+
+
+def topic_urls(topics):
+    ids = [corpus.BOARD_TOPIC_BASE[132] + position for position in range(topics)]
+    return [f"https://geekhack.org/index.php?topic={topic_id}.0" for topic_id in ids]
+
+
+def deepest_topics(topics):
+    candidates = range(corpus.BOARD_TOPIC_BASE[132], corpus.BOARD_TOPIC_BASE[132] + 300)
+    return sorted(candidates, key=corpus.topic_replies, reverse=True)[:topics]
+
+
+def fetch_all(urls):
+    return [(url, fetch(url).content) for url in urls]
+
+
+def bench_board_pages(options, server):
+    urls = board_urls()
+
+    def run():
+        for _ in map_concurrently(get_page_posts_small_data, urls, options["workers"]):
+            pass
+        return len(urls)
+
+    markups = fetch_all(urls)
+
+    def parse():
+        for url, markup in markups:
+            parse_page_posts_small_data(markup, url)
+        return len(markups)
+
+    return measure("get_page_posts_small_data", run, parse, server)
+
+
+def bench_post_data(options, server):
+    urls = topic_urls(options["topics"])
+
+    def run():
+        for _ in get_posts_data(urls, options["workers"]):
+            pass
+        return len(urls)
+
+    markups = fetch_all(urls)
+
+    def parse():
+        # albums are cached by the run, so this times the html alone
+        for _, markup in markups:
+            parse_post_data(markup)
+        return len(markups)
+
+    return measure("get_post_data", run, parse, server)
+
+
+def comment_pages(options):
+    return [
+        (topic_id, count)
+        for topic_id in deepest_topics(options["deep_topics"])
+        for count in range(0, corpus.topic_last_page_count(topic_id) + 1, 50)
+    ]
+
+
+def bench_page_comments(options, server):
+    pages = comment_pages(options)
+
+    def run():
+        for _ in map_concurrently(
+            lambda page: scrape_page_comments(*page), pages, options["workers"]
+        ):
+            pass
+        return len(pages)
+
+    markups = [
+        (
+            topic_id,
+            count,
+            fetch(f"https://geekhack.org/index.php?topic={topic_id}.{count}").content,
+        )
+        for topic_id, count in pages
+    ]
+
+    def parse():
+        for topic_id, count, markup in markups:
+            parse_page_comments(markup, topic_id, count)
+        return len(markups)
+
+    return measure("scrape_page_comments", run, parse, server)
+
+
+def clear_database():
+    from ..extensions import db
+
+    db.session.execute(
+        db.text(
+            "TRUNCATE comment, image, post, topic_index, crawl_state RESTART IDENTITY"
+        )
+    )
+    db.session.commit()
+
+
+def bench_update(options, server):
+    from ..util import crawl_board
+
+    progress = Counter()
+
+    def run():
+        progress.counts = {}
+        crawl_board(
+            132, limit=options["topics"], workers=options["workers"], progress=progress
+        )
+        return progress.counts.get("pages", 0)
+
+    result = measure("update", run, server=server, setup=clear_database)
+    result["posts"] = progress.counts.get("posts", 0)
+    result["comments"] = progress.counts.get("comments", 0)
+    return result
+
+
+def bench_process_post_comments(options, server):
+    from ..extensions import db
+    from ..models import Comment, Post
+    from ..util import process_post, process_post_comments
+
+    topic_ids = deepest_topics(options["deep_topics"])
+    for topic_id in topic_ids:
+        if Post.get(topic_id=topic_id, include_images=False) is None:
+            _, position = corpus.topic_board(topic_id)
+            small_data = find_topic_on_board_page(topic_id, 132, (position // 50) * 50)
+            process_post(
+                get_all_post_data(small_data, get_post_data(small_data["url"]))
+            )
+
+    def clear_comments():
+        # start from no stored comments so every page is scraped and inserted
+        Comment.query.filter(Comment.post_topic_id.in_(topic_ids)).delete()
+        db.session.commit()
+
+    def run():
+        for topic_id in topic_ids:
+            process_post_comments(topic_id)
+        return len(comment_pages(options))
+
+    return measure("process_post_comments", run, server=server, setup=clear_comments)
+
+
+def bench_long_thread(options, server):
+    """
+    Sync threads of growing length from scratch, one result per length
+    Peak memory should stay the same for every length, since comments are committed every few pages
+    """
+    from ..extensions import db
+    from ..models import Comment, Post
+    from ..util import process_post_comments
+
+    results = []
+    # comment pages are final, so they go to the disk cache rather than the crawl memo,
+    # like in production
+    use_cache, cache_dir = cache.CACHE_ENABLED, cache.CACHE_DIR
+    cache.CACHE_ENABLED = True
+    cache.CACHE_DIR = tempfile.mkdtemp(prefix="keytonomy-bench-cache-")
+    try:
+        for replies in options["long_replies"]:
+            topic_id = corpus.long_thread(replies)
+            if Post.get(topic_id=topic_id, include_images=False) is None:
+                db.session.add(
+                    Post(
+                        title=f"long thread {replies}",
+                        topic_id=topic_id,
+                        url=f"https://geekhack.org/index.php?topic={topic_id}.0",
+                        creator=corpus.USERS[0],
+                        created=corpus.BASE_TIME,
+                        last_updated=corpus.BASE_TIME,
+                        post_type="GB",
+                    )
+                )
+                db.session.commit()
+
+            def clear_comments():
+                Comment.query.filter_by(post_topic_id=topic_id).delete()
+                db.session.commit()
+                # fetch every page again rather than reading the previous run's cache
+                shutil.rmtree(cache.CACHE_DIR, ignore_errors=True)
+
+            def run():
+                process_post_comments(topic_id, max_workers=options["workers"])
+                return corpus.topic_last_page_count(topic_id) // 50 + 1
+
+            result = measure(
+                f"long_thread {replies}", run, server=server, setup=clear_comments
+            )
+            result["comments"] = replies
+            results.append(result)
+    finally:
+        shutil.rmtree(cache.CACHE_DIR, ignore_errors=True)
+        cache.CACHE_ENABLED, cache.CACHE_DIR = use_cache, cache_dir
+    return results
+
+
+RUNNERS = {
+    "get_page_posts_small_data": bench_board_pages,
+    "get_post_data": bench_post_data,
+    "scrape_page_comments": bench_page_comments,
+    "update": bench_update,
+    "process_post_comments": bench_process_post_comments,
+    "long_thread": bench_long_thread,
+}
+
+
+def run_suite(server, benches, options, verbose=False):
+    results = []
+    for name in benches:
+        # the scrapers print every page and post, keep that out of the report unless asked
+        with open(os.devnull, "w") as devnull:
+            with nullcontext() if verbose else redirect_stdout(devnull):
+                result = RUNNERS[name](options, server)
+                # a bench may report several results, long_thread has one per thread length
+                results.extend(result if isinstance(result, list) else [result])
+    return results
+
+
+def format_results(results):
+    lines = [
+        f"{'bench':<28}{'pages':>7}{'pages/s':>10}{'parse ms/page':>15}{'peak MB':>10}"
+    ]
+    for result in results:
+        parse_ms = "-" if result["parse_ms"] is None else f"{result['parse_ms']:.1f}"
+        lines.append(
+            f"{result['name']:<28}{result['pages']:>7}{result['pages_per_sec']:>10.1f}"
+            f"{parse_ms:>15}{result['peak_mb']:>10.1f}"
+        )
+    return "\n".join(lines)
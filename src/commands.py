@@ -1,10 +1,311 @@
 import click
+import shutil
+import time
+from contextlib import nullcontext
+
+from flask import current_app
 from flask.cli import with_appcontext
 
 from .extensions import db
+from .scrape.comments import parse_page_comments
+from .scrape.parser import available_backends
 
 
 @click.command(name="create_tables")
 @with_appcontext
 def create_tables():
     db.create_all()
+
+
+@click.command(name="upgrade_db")
+@with_appcontext
+def upgrade_db():
+    """
+    Create missing tables and apply schema migrations to existing ones
+    """
+    from .migrations import upgrade
+
+    upgrade()
+
+
+@click.command(name="backfill_comment_messages")
+@click.option("--batch-size", default=1000, help="Rows written per transaction.")
+@with_appcontext
+def backfill_comment_messages(batch_size):
+    """
+    Copy comment messages into the jsonb column ahead of upgrade_db swapping it in
+    Safe to stop and run again, rows already copied are skipped
+    """
+    from .migrations import apply, backfill_comment_messages
+
+    apply("comment_message_json_column")
+    written = backfill_comment_messages(batch_size=batch_size)
+    click.echo(f"Backfilled {written} comment messages")
+
+
+@click.command(name="run_worker")
+@click.option(
+    "--poll-interval", default=5, help="Seconds to wait when the queue is empty."
+)
+@click.option("--once", is_flag=True, help="Exit once the queue is empty.")
+@with_appcontext
+def run_worker(poll_interval, once):
+    """
+    Execute jobs queued through /api/update and /api/comments/update
+    """
+    from .jobs import work
+
+    work(poll_interval=poll_interval, once=once)
+
+
+@click.command(name="run_scheduler")
+@with_appcontext
+def run_scheduler():
+    """
+    Periodically queue delta syncs of the IC and GB boards and comment refreshes of active threads
+    The jobs are executed by run_worker
+    """
+    from .scheduler import Scheduler
+
+    Scheduler().run_forever()
+
+
+@click.command(name="bench_parsers")
+@click.argument("html_files", nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option("--topic-id", default=0, help="Topic id the saved pages belong to.")
+@click.option("--count", default=50, help="Page offset; 0 skips the opening post.")
+@click.option("--repeat", default=5, help="Parses per page per backend.")
+def bench_parsers(html_files, topic_id, count, repeat):
+    """
+    Parse saved comment pages with every available backend
+    Checks each backend produces the same comment dicts as html5lib and reports parse ms/page
+    """
+    backends = available_backends()
+    pages = []
+    for path in html_files:
+        with open(path, "rb") as f:
+            pages.append((path, f.read()))
+
+    reference = "html5lib" if "html5lib" in backends else backends[0]
+    expected = {
+        path: parse_page_comments(markup, topic_id, count, backend=reference)
+        for path, markup in pages
+    }
+
+    failed = False
+    for backend in backends:
+        mismatches = []
+        elapsed = 0
+        for path, markup in pages:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                comments = parse_page_comments(markup, topic_id, count, backend=backend)
+            elapsed += time.perf_counter() - start
+            if comments != expected[path]:
+                mismatches.append(path)
+
+        parse_ms = elapsed * 1000 / max(len(pages) * repeat, 1)
+        click.echo(f"{backend}: {parse_ms:.1f} ms/page")
+        for path in mismatches:
+            failed = True
+            click.echo(f"  differs from {reference}: {path}")
+
+    if failed:
+        raise SystemExit(1)
+
+
+@click.group(name="bench")
+def bench_cli():
+    """
+    Offline geekhack stand-in server, page corpus and scraper benchmarks
+    """
+
+
+@bench_cli.command(name="serve")
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8765)
+@click.option(
+    "--corpus-dir",
+    type=click.Path(file_okay=False),
+    help="Recorded pages served before synthetic ones.",
+)
+@click.option("--latency", default=0.0, help="Mean seconds added to every response.")
+@click.option(
+    "--error-rate",
+    default=0.0,
+    help="Fraction of requests answered with --error-status.",
+)
+@click.option("--error-status", default=500)
+def bench_serve(host, port, corpus_dir, latency, error_rate, error_status):
+    """
+    Serve geekhack pages locally, point the app at it with GEEKHACK_URL and IMGUR_API_URL
+    """
+    from .bench.server import StandInServer
+
+    server = StandInServer(
+        (host, port),
+        corpus_dir=corpus_dir,
+        latency=latency,
+        error_rate=error_rate,
+        error_status=error_status,
+        verbose=True,
+    )
+    click.echo(
+        f"Serving on {server.url} (GEEKHACK_URL={server.url} IMGUR_API_URL={server.url}/3)"
+    )
+    server.serve_forever()
+
+
+@bench_cli.command(name="corpus")
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.option(
+    "--topics", default=10, help="Deepest synthetic topics to write every page of."
+)
+def bench_corpus(directory, topics):
+    """
+    Write the synthetic board and topic pages to a directory
+    """
+    from .bench.corpus import build
+
+    click.echo(f"Wrote {build(directory, topics)} pages to {directory}")
+
+
+@bench_cli.command(name="record")
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.argument("urls", nargs=-1, required=True)
+def bench_record(directory, urls):
+    """
+    Save live geekhack pages to a corpus directory
+    """
+    from .bench.corpus import record
+
+    record(urls, directory)
+
+
+@bench_cli.command(name="run")
+@click.option(
+    "--only",
+    multiple=True,
+    help="Bench to run, repeatable. Defaults to every scraper bench.",
+)
+@click.option(
+    "--bench-db-url",
+    envvar="BENCH_DATABASE_URL",
+    help="Scratch database the database benches truncate and write to, enables them.",
+)
+@click.option("--corpus-dir", type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "--latency", default=0.0, help="Mean seconds the stand-in adds to every response."
+)
+@click.option(
+    "--error-rate", default=0.0, help="Fraction of stand-in responses that fail."
+)
+@click.option("--error-status", default=500)
+@click.option(
+    "--workers",
+    default=None,
+    type=int,
+    help="Fetch threads, defaults to SCRAPE_MAX_WORKERS.",
+)
+@click.option(
+    "--parser", "backend", default=None, help="bs4 backend, defaults to SCRAPE_PARSER."
+)
+@click.option(
+    "--processes", default=0, help="Parse processes, 0 parses on the fetch threads."
+)
+@click.option(
+    "--rate", default=1000.0, help="Requests per second allowed by the rate limiter."
+)
+@click.option(
+    "--cache", "use_cache", is_flag=True, help="Go through the disk page cache."
+)
+@click.option(
+    "--topics", default=50, help="Topics fetched by get_post_data and update."
+)
+@click.option(
+    "--deep-topics", default=3, help="Longest threads scraped by the comment benches."
+)
+@click.option(
+    "--long-replies",
+    multiple=True,
+    default=[1000, 5000],
+    type=int,
+    help="Reply counts of the threads synced by long_thread, repeatable.",
+)
+@click.option("--verbose", is_flag=True, help="Keep the scrapers' output.")
+@with_appcontext
+def bench_run(
+    only,
+    bench_db_url,
+    corpus_dir,
+    latency,
+    error_rate,
+    error_status,
+    workers,
+    backend,
+    processes,
+    rate,
+    use_cache,
+    topics,
+    deep_topics,
+    long_replies,
+    verbose,
+):
+    """
+    Benchmark the scrapers against an in-process stand-in server
+    Reports pages/sec, parse ms/page on already fetched markup and tracemalloc peak memory
+    """
+    from .bench.server import start_server
+    from .bench.suite import (
+        BENCHES,
+        DB_BENCHES,
+        configure,
+        database_app,
+        format_results,
+        run_suite,
+        same_database,
+    )
+
+    benches = list(only) or [
+        name for name in BENCHES if bench_db_url or name not in DB_BENCHES
+    ]
+    unknown = [name for name in benches if name not in BENCHES]
+    if unknown:
+        raise click.BadParameter(
+            f"unknown bench {', '.join(unknown)}, pick from {', '.join(BENCHES)}"
+        )
+    bench_app = None
+    if any(name in DB_BENCHES for name in benches):
+        if not bench_db_url:
+            raise click.BadParameter(
+                f"{', '.join(DB_BENCHES)} need --bench-db-url or BENCH_DATABASE_URL"
+            )
+        if same_database(bench_db_url, current_app.config["SQLALCHEMY_DATABASE_URI"]):
+            raise click.BadParameter(
+                "--bench-db-url is the app's database, the database benches truncate it"
+            )
+        bench_app = database_app(bench_db_url)
+
+    server = start_server(
+        corpus_dir=corpus_dir,
+        latency=latency,
+        error_rate=error_rate,
+        error_status=error_status,
+    )
+    scratch = configure(
+        server, backend=backend, processes=processes, rate=rate, use_cache=use_cache
+    )
+    options = {
+        "workers": workers,
+        "topics": topics,
+        "deep_topics": deep_topics,
+        "long_replies": long_replies,
+    }
+    try:
+        # the database benches only ever see the scratch database's engine
+        with bench_app.app_context() if bench_app else nullcontext():
+            results = run_suite(server, benches, options, verbose=verbose)
+    finally:
+        server.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+    click.echo(format_results(results))
@@ -0,0 +1,294 @@
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from .extensions import db
+from .models import CrawlRun, Job
+from .scrape.crawl import crawl_scope
+from .scrape.posts import BOARDS
+from .util import crawl_board, process_post_comments, save_crawl_run
+
+# database backed job queue - the api enqueues, the run_worker command executes
+POLL_INTERVAL = 5
+# a running job whose worker has not renewed its heartbeat for this long is assumed dead and requeued
+JOB_LEASE = int(os.environ.get("JOB_LEASE", 10 * 60))
+HEARTBEAT_INTERVAL = JOB_LEASE / 5
+# finished jobs and crawl runs are kept this many days
+RETENTION_DAYS = int(os.environ.get("JOB_RETENTION_DAYS", 7))
+
+
+class JobLease:
+    """
+    Renews the heartbeat of a claimed job from a background thread while the job runs
+    started_at identifies the claim, so once a job is requeued and claimed again the old worker's writes match nothing
+    """
+
+    def __init__(self, job_id, started_at, interval=HEARTBEAT_INTERVAL):
+        self.job_id = job_id
+        self.started_at = started_at
+        self.interval = interval
+        self.engine = db.engine
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+
+    def held(self):
+        return (
+            (Job.id == self.job_id)
+            & (Job.status == "running")
+            & (Job.started_at == self.started_at)
+        )
+
+    def beat(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                with self.engine.begin() as connection:
+                    renewed = connection.execute(
+                        db.update(Job)
+                        .where(self.held())
+                        .values(heartbeat_at=datetime.utcnow())
+                    ).rowcount
+            except SQLAlchemyError as e:
+                print(f"Failed to renew the lease on job {self.job_id}: {e}")
+                continue
+            if not renewed:
+                print(f"Lost the lease on job {self.job_id}")
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+class JobProgress:
+    """
+    Counts pages, posts and comments processed by a job and writes them to its row
+    Writes go through their own connection so the crawl's session commits are left alone
+    """
+
+    def __init__(self, lease, flush_interval=2):
+        self.lease = lease
+        self.flush_interval = flush_interval
+        self.counts = {"pages": 0, "posts": 0, "comments": 0}
+        self.flushed_at = 0
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + (value or 0)
+        if time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.flushed_at = time.monotonic()
+        with db.engine.begin() as connection:
+            connection.execute(
+                db.update(Job).where(self.lease.held()).values(progress=self.counts)
+            )
+
+
+def run_update(params, progress):
+    post_type = params["post_type"]
+    if post_type == "DB":
+        post_types = ["IC", "GB"]
+    else:
+        post_types = [post_type]
+
+    for board_type in post_types:
+        print(f"\nWorking on {board_type}\n")
+        crawl_board(
+            BOARDS[board_type],
+            limit=params.get("limit"),
+            workers=params.get("workers"),
+            delta=params.get("delta", False),
+            progress=progress,
+        )
+    return {"message": f"Successfully updated {post_type}."}
+
+
+def run_update_comments(params, progress):
+    post_topic_id = params["post_topic_id"]
+    new_comments = process_post_comments(post_topic_id)
+    progress.add(posts=1, comments=new_comments)
+    return {"message": f"Successfully updated comments related to {post_topic_id}"}
+
+
+JOB_HANDLERS = {
+    "update": run_update,
+    "update_comments": run_update_comments,
+}
+
+
+def enqueue(kind, params):
+    """
+    Queue a job, or return the identical job that is already waiting
+    The partial unique index on queued jobs makes the insert and the duplicate check one statement
+    """
+    while True:
+        try:
+            job_id = db.session.execute(
+                insert(Job)
+                .values(
+                    kind=kind,
+                    params=params,
+                    status="queued",
+                    progress={},
+                    created_at=datetime.utcnow(),
+                )
+                .on_conflict_do_nothing(
+                    index_elements=[Job.kind, Job.params],
+                    index_where=Job.status == "queued",
+                )
+                .returning(Job.id)
+            ).scalar()
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        if job_id is not None:
+            return db.session.get(Job, job_id)
+
+        queued = Job.query.filter_by(kind=kind, status="queued", params=params).first()
+        if queued:
+            return queued
+        # the waiting copy was claimed in between, insert again
+
+
+def prune_finished_jobs(days=RETENTION_DAYS):
+    """
+    Delete done and failed jobs that finished more than days ago, and crawl runs as old
+    Returns the number of jobs and crawl runs deleted
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    old_jobs = db.select(Job.id).where(
+        Job.status.in_(["done", "failed"]), Job.finished_at < cutoff
+    )
+    try:
+        # crawl runs first, they reference their job
+        runs = db.session.execute(
+            db.delete(CrawlRun).where(
+                db.or_(CrawlRun.job_id.in_(old_jobs), CrawlRun.finished_at < cutoff)
+            )
+        ).rowcount
+        jobs = db.session.execute(db.delete(Job).where(Job.id.in_(old_jobs))).rowcount
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return jobs, runs
+
+
+def requeue_expired_jobs():
+    """
+    Put running jobs whose lease has run out back in the queue
+    A job identical to one already waiting is failed instead, the waiting copy will do its work
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=JOB_LEASE)
+    expired = (
+        Job.query.filter(
+            Job.status == "running",
+            db.func.coalesce(Job.heartbeat_at, Job.started_at) < cutoff,
+        )
+        .order_by(Job.id)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    for job in expired:
+        try:
+            with db.session.begin_nested():
+                job.status = "queued"
+                job.started_at = None
+                job.heartbeat_at = None
+                job.progress = {}
+            print(f"Requeued job {job.id}, its lease expired")
+        except IntegrityError:
+            job.status = "failed"
+            job.error = "Lease expired while an identical job was queued"
+            job.finished_at = datetime.utcnow()
+            print(
+                f"Failed job {job.id}, its lease expired and an identical job is queued"
+            )
+    db.session.commit()
+
+
+def claim_next_job():
+    """
+    Lock the oldest queued job and mark it running, returns a lease on it
+    SKIP LOCKED lets several workers poll the same table without taking the same job
+    """
+    requeue_expired_jobs()
+    job = (
+        Job.query.filter_by(status="queued")
+        .order_by(Job.id)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if job is None:
+        db.session.rollback()
+        return None
+    started_at = datetime.utcnow()
+    job.status = "running"
+    job.started_at = job.heartbeat_at = started_at
+    db.session.commit()
+    return JobLease(job.id, started_at)
+
+
+def finish_job(lease, status, progress, result=None, error=None):
+    with db.engine.begin() as connection:
+        finished = connection.execute(
+            db.update(Job)
+            .where(lease.held())
+            .values(
+                status=status,
+                progress=progress.counts,
+                result=result,
+                error=error,
+                finished_at=datetime.utcnow(),
+            )
+        ).rowcount
+    if not finished:
+        print(
+            f"Job {lease.job_id} was requeued while it ran, not recording its {status} status"
+        )
+
+
+def run_job(lease):
+    job_id = lease.job_id
+    job = db.session.get(Job, job_id)
+    kind, params = job.kind, dict(job.params)
+    db.session.close()
+
+    progress = JobProgress(lease)
+    print(f"Running job {job_id} ({kind}) {params}")
+    key = params.get("post_type") or params.get("post_topic_id")
+    with lease, crawl_scope() as crawl:
+        try:
+            result = JOB_HANDLERS[kind](params, progress)
+        except Exception as e:
+            db.session.rollback()
+            traceback.print_exc()
+            finish_job(lease, "failed", progress, error=str(e))
+            save_crawl_run(kind, key, crawl, "failed", job_id=job_id)
+            return
+        finally:
+            db.session.close()
+        finish_job(lease, "done", progress, result=result)
+        save_crawl_run(kind, key, crawl, "done", job_id=job_id)
+
+
+def work(poll_interval=POLL_INTERVAL, once=False):
+    while True:
+        lease = claim_next_job()
+        if lease is not None:
+            run_job(lease)
+            continue
+        if once:
+            return
+        time.sleep(poll_interval)
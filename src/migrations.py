@@ -0,0 +1,227 @@
+import json
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.dialects.postgresql import JSONB
+
+from .extensions import db
+from .models import POST_SEARCH_VECTOR
+
+# rows decoded and written per transaction by backfill_comment_messages
+BACKFILL_BATCH_SIZE = 1000
+
+
+def decode_message(items):
+    """
+    Turn a message stored as a text array, with quotes json encoded into its elements, back into nested lists and dicts
+    """
+    decoded = []
+    for item in items:
+        if isinstance(item, str) and item.startswith("{"):
+            try:
+                quote = json.loads(item)
+            except json.JSONDecodeError:
+                quote = None
+            if isinstance(quote, dict):
+                if isinstance(quote.get("message"), list):
+                    quote["message"] = decode_message(quote["message"])
+                decoded.append(quote)
+                continue
+        decoded.append(item)
+    return decoded
+
+
+def backfill_comment_messages(batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Copy comment.message into the message_json column added by comment_message_json_column, batch_size rows per transaction
+    Picks up where it stopped when run again, returns how many rows were written
+    """
+    with db.engine.connect() as connection:
+        pending = connection.execute(
+            text(
+                "SELECT 1 FROM information_schema.columns "
+                "WHERE table_name = 'comment' AND column_name = 'message_json'"
+            )
+        ).first()
+    if pending is None:
+        return 0
+
+    update = text(
+        "UPDATE comment SET message_json = :message WHERE id = :id"
+    ).bindparams(bindparam("message", type_=JSONB))
+    written = 0
+    last_id = 0
+    while True:
+        with db.engine.begin() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT id, message FROM comment "
+                    "WHERE id > :last_id AND message_json IS NULL AND message IS NOT NULL "
+                    "ORDER BY id LIMIT :batch_size"
+                ),
+                {"last_id": last_id, "batch_size": batch_size},
+            ).all()
+            if not rows:
+                return written
+            connection.execute(
+                update,
+                [
+                    {"id": id, "message": decode_message(message)}
+                    for id, message in rows
+                ],
+            )
+        written += len(rows)
+        last_id = rows[-1].id
+        print(f"Backfilled {written} comment messages")
+
+
+# schema changes create_all cannot make to existing tables, applied in order by the upgrade_db command
+# every step checks the catalog first, so running the whole list again is harmless
+# a step is either a list of statements run in one transaction or a function that manages its own
+MIGRATIONS = [
+    (
+        "comment_unique_number",
+        [
+            # keep the first copy of every reply stored more than once
+            """
+            DELETE FROM comment duplicate
+            USING comment original
+            WHERE duplicate.post_topic_id = original.post_topic_id
+              AND duplicate.number = original.number
+              AND duplicate.id > original.id
+            """,
+            """
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_constraint WHERE conname = 'comment_post_topic_id_number_key'
+                ) THEN
+                    ALTER TABLE comment
+                    ADD CONSTRAINT comment_post_topic_id_number_key UNIQUE (post_topic_id, number);
+                END IF;
+            END $$
+            """,
+        ],
+    ),
+    (
+        "post_body",
+        [
+            "ALTER TABLE post ADD COLUMN IF NOT EXISTS body TEXT",
+            "ALTER TABLE post ADD COLUMN IF NOT EXISTS body_hash VARCHAR(40)",
+        ],
+    ),
+    # comment.message goes from a text array with json encoded quotes to jsonb:
+    # add a jsonb column, backfill it in batches, then swap it in once every row is copied
+    (
+        "comment_message_json_column",
+        [
+            """
+            DO $$
+            BEGIN
+                IF EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name = 'comment' AND column_name = 'message' AND data_type = 'ARRAY'
+                ) THEN
+                    ALTER TABLE comment ADD COLUMN IF NOT EXISTS message_json JSONB;
+                END IF;
+            END $$
+            """,
+        ],
+    ),
+    ("comment_message_backfill", backfill_comment_messages),
+    (
+        "comment_message_swap",
+        [
+            """
+            DO $$
+            BEGIN
+                IF EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name = 'comment' AND column_name = 'message_json'
+                ) THEN
+                    IF EXISTS (
+                        SELECT 1 FROM comment WHERE message_json IS NULL AND message IS NOT NULL
+                    ) THEN
+                        RAISE EXCEPTION 'comment messages are not fully backfilled, run backfill_comment_messages';
+                    END IF;
+                    ALTER TABLE comment DROP COLUMN message;
+                    ALTER TABLE comment RENAME COLUMN message_json TO message;
+                END IF;
+            END $$
+            """,
+        ],
+    ),
+    (
+        "post_search",
+        [
+            f"""
+            ALTER TABLE post ADD COLUMN IF NOT EXISTS search_vector TSVECTOR
+            GENERATED ALWAYS AS ({POST_SEARCH_VECTOR}) STORED
+            """,
+            "CREATE INDEX IF NOT EXISTS post_search_vector_idx ON post USING gin (search_vector)",
+        ],
+    ),
+    (
+        "post_keyset_indexes",
+        [
+            "CREATE INDEX IF NOT EXISTS post_last_updated_topic_id_idx ON post (last_updated, topic_id)",
+            "CREATE INDEX IF NOT EXISTS post_created_topic_id_idx ON post (created, topic_id)",
+        ],
+    ),
+    # typo tolerant title matching, skipped where the pg_trgm extension is not available
+    (
+        "post_title_trigram",
+        [
+            """
+            DO $$
+            BEGIN
+                IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+                    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                    CREATE INDEX IF NOT EXISTS post_title_trgm_idx ON post USING gin (title gin_trgm_ops);
+                ELSE
+                    RAISE NOTICE 'pg_trgm is not available, search matches titles by full text only';
+                END IF;
+            END $$
+            """,
+        ],
+    ),
+    (
+        "job_lease",
+        [
+            "ALTER TABLE job ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP WITHOUT TIME ZONE",
+            # keep the oldest of identical queued jobs
+            """
+            DELETE FROM job duplicate
+            USING job original
+            WHERE duplicate.status = 'queued'
+              AND original.status = 'queued'
+              AND duplicate.kind = original.kind
+              AND duplicate.params = original.params
+              AND duplicate.id > original.id
+            """,
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS job_queued_kind_params_key
+            ON job (kind, params) WHERE status = 'queued'
+            """,
+        ],
+    ),
+]
+
+
+def upgrade():
+    """
+    Create missing tables, then apply every migration in order
+    """
+    db.create_all()
+    for name, _ in MIGRATIONS:
+        apply(name)
+
+
+def apply(name):
+    statements = dict(MIGRATIONS)[name]
+    print(f"Applying {name}")
+    if callable(statements):
+        statements()
+        return
+    with db.engine.begin() as connection:
+        for statement in statements:
+            connection.execute(text(statement))
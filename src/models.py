@@ -1,10 +1,46 @@
 from .extensions import db
-import json
-from sqlalchemy.dialects.postgresql import JSONB, ARRAY
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 from datetime import datetime
+from functools import lru_cache
+
+from .pagination import keyset_paginate, range_paginate
+
+# opening post html without its tags, what search matches and highlights
+POST_BODY_TEXT = "regexp_replace(coalesce(body, ''), '<[^>]*>', ' ', 'g')"
+# weighted title > creator > body, computed by postgres whenever a post is written
+POST_SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(creator, '')), 'B') || "
+    f"setweight(to_tsvector('english', {POST_BODY_TEXT}), 'C')"
+)
+# replies per page on geekhack, comment page k holds reply numbers [(k - 1) * 50, k * 50)
+COMMENTS_PER_PAGE = 50
+SEARCH_HEADLINE_OPTIONS = (
+    "MaxFragments=2, MinWords=8, MaxWords=24, StartSel=<mark>, StopSel=</mark>"
+)
+
+
+@lru_cache(1)
+def trigram_available():
+    """
+    Whether pg_trgm is installed, search falls back to full-text matching alone without it
+    """
+    return (
+        db.session.execute(
+            db.text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        ).first()
+        is not None
+    )
 
 
 class Post(db.Model):
+    __table_args__ = (
+        db.Index("post_search_vector_idx", "search_vector", postgresql_using="gin"),
+        # cursor pagination of the latest and newest listings seeks through these
+        db.Index("post_last_updated_topic_id_idx", "last_updated", "topic_id"),
+        db.Index("post_created_topic_id_idx", "created", "topic_id"),
+    )
+
     topic_id = db.Column(db.Integer, primary_key=True, nullable=False)
     title = db.Column(db.Text, nullable=False)
     url = db.Column(db.Text, nullable=False)
@@ -12,6 +48,10 @@ class Post(db.Model):
     created = db.Column(db.DateTime, nullable=False)
     last_updated = db.Column(db.DateTime, nullable=False)
     post_type = db.Column(db.String(2), nullable=False)
+    body = db.Column(db.Text)
+    # hash of the opening post's html, images are only extracted again when it changes
+    body_hash = db.Column(db.String(40))
+    search_vector = db.Column(TSVECTOR, db.Computed(POST_SEARCH_VECTOR, persisted=True))
 
     images = db.relationship(
         "Image",
@@ -29,7 +69,18 @@ class Post(db.Model):
         lazy="noload",
     )
 
-    def __init__(self, title, topic_id, url, creator, created, last_updated, post_type):
+    def __init__(
+        self,
+        title,
+        topic_id,
+        url,
+        creator,
+        created,
+        last_updated,
+        post_type,
+        body=None,
+        body_hash=None,
+    ):
         self.topic_id = topic_id
         self.title = title
         self.url = url
@@ -37,6 +88,8 @@ class Post(db.Model):
         self.created = created
         self.last_updated = last_updated
         self.post_type = post_type
+        self.body = body
+        self.body_hash = body_hash
 
     def handle_include_comments(
         posts, include_comments, comment_page, comment_per_page
@@ -62,6 +115,51 @@ class Post(db.Model):
                     post.comment_pagination = comment_pagination
         return posts
 
+    def search(search_query, page=1, per_page=25, cursor=None):
+        """
+        Posts matching search_query, most relevant first, with highlighted title and body snippets
+        Matches the full-text vector, and titles spelled close to the query when pg_trgm is installed
+        Returns a list of (post, rank, title_headline, body_headline) and the pagination,
+        or the cursor page info when cursor is given ("" for the first page)
+        """
+        tsquery = db.func.websearch_to_tsquery("english", search_query)
+        rank = db.func.ts_rank_cd(Post.search_vector, tsquery)
+        condition = Post.search_vector.op("@@")(tsquery)
+        if trigram_available():
+            # <% matches titles holding a word spelled close to the query, served by post_title_trgm_idx
+            condition = db.or_(condition, db.literal(search_query).op("<%")(Post.title))
+            rank = rank + db.func.word_similarity(search_query, Post.title)
+        # double precision so a rank read back from a cursor compares equal to the one computed again
+        rank = db.cast(rank, db.Float)
+
+        query = (
+            db.session.query(
+                Post,
+                rank.label("rank"),
+                db.func.ts_headline(
+                    "english", Post.title, tsquery, SEARCH_HEADLINE_OPTIONS
+                ).label("title_headline"),
+                db.func.ts_headline(
+                    "english", db.text(POST_BODY_TEXT), tsquery, SEARCH_HEADLINE_OPTIONS
+                ).label("body_headline"),
+            )
+            .options(db.selectinload(Post.images), db.defer(Post.body))
+            .filter(condition)
+        )
+        if cursor is not None:
+            return keyset_paginate(
+                query,
+                [rank, Post.topic_id],
+                per_page,
+                cursor,
+                key_of=lambda row: [row.rank, row.Post.topic_id],
+            )
+
+        pagination = query.order_by(rank.desc(), Post.topic_id.desc()).paginate(
+            page=page, per_page=per_page
+        )
+        return pagination.items, pagination
+
     def get(
         many=False,
         page=None,
@@ -72,6 +170,7 @@ class Post(db.Model):
         comment_per_page=25,
         order_by=None,
         order_dir=None,
+        cursor=None,
         **query_options,
     ):
         query = Post.query
@@ -85,6 +184,20 @@ class Post(db.Model):
                 else:
                     query = query.filter(column == value)
         if many:
+            # listings never serve the opening post's markup
+            query = query.options(db.defer(Post.body))
+            # cursor pagination (cursor is "" for the first page), always newest first on (order_by, topic_id)
+            if cursor is not None:
+                if order_by is None or not isinstance(per_page, int):
+                    raise ValueError("Cursor pagination needs order_by and per_page")
+                posts, page_info = keyset_paginate(
+                    query, [getattr(Post, order_by), Post.topic_id], per_page, cursor
+                )
+                Post.handle_include_comments(
+                    posts, include_comments, comment_page, comment_per_page
+                )
+                return posts, page_info
+
             if order_by is not None and order_dir is not None:
                 column = getattr(Post, order_by)
             if order_dir == "asc":
@@ -126,13 +239,21 @@ class Image(db.Model):
 
 
 class Comment(db.Model):
+    # a reply number appears once per topic, so re-scraping a thread can never duplicate it
+    __table_args__ = (
+        db.UniqueConstraint(
+            "post_topic_id", "number", name="comment_post_topic_id_number_key"
+        ),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     message_id = db.Column(db.Integer)
     post_topic_id = db.Column(db.Integer, db.ForeignKey("post.topic_id"))
     number = db.Column(db.SmallInteger)
     link = db.Column(db.String(80))  # currently at 67
     commenter = db.Column(db.Text)
-    message = db.Column(ARRAY(db.Text))
+    # text and nested quote dicts ({commenter, created_at, message}) as parsed by scrape_comment
+    message = db.Column(JSONB)
     is_starter = db.Column(db.Boolean, default=False)
     attachment = db.Column(db.Text)
     created_at = db.Column(db.DateTime)
@@ -158,26 +279,127 @@ class Comment(db.Model):
         self.is_starter = is_starter
         self.attachment = attachment
         self.created_at = created_at
-        self.message = self.serialize_message(message)
-
-    def serialize_dict(self, d):
-        serialized = {}
-        for key, value in d.items():
-            # if key == "created_at":
-            #     serialized[key] = datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
-            if isinstance(value, list):
-                serialized[key] = self.serialize_message(value)
-            else:
-                serialized[key] = value
-        return json.dumps(serialized)
-
-    def serialize_message(self, message):
-        serialized_list = []
-        for item in message:
-            if isinstance(item, dict):
-                d = self.serialize_dict(item)
-                serialized_list.append(d)
-            elif isinstance(item, str):
-                serialized_list.append(item)
-
-        return serialized_list
+
+    def last_number(post_topic_id):
+        return (
+            db.session.query(db.func.max(Comment.number))
+            .filter(Comment.post_topic_id == post_topic_id)
+            .scalar()
+        ) or 0
+
+    def get_page(
+        post_topic_id, page=1, per_page=COMMENTS_PER_PAGE, sort="asc", last_number=None
+    ):
+        """
+        Comments of a topic by reply number range, page k holding numbers [(k - 1) * per_page, k * per_page)
+        With the default per_page the pages are geekhack's own
+        desc pages count back from the last reply instead, page 1 holding the newest per_page replies
+        last_number is looked up when not given
+        """
+        if last_number is None:
+            last_number = Comment.last_number(post_topic_id)
+        return range_paginate(
+            Comment.query.filter(Comment.post_topic_id == post_topic_id),
+            Comment.number,
+            last_number,
+            page,
+            per_page,
+            reverse=sort == "desc",
+        )
+
+    def page_of(number, per_page=COMMENTS_PER_PAGE, sort="asc", last_number=None):
+        """
+        Page of get_page holding reply number, desc needs the topic's last reply number
+        """
+        if sort == "desc":
+            return (last_number - number) // per_page + 1
+        return number // per_page + 1
+
+
+# where each topic was last seen on its board, kept current by the board crawls
+# so a single topic can be found again without walking the board from the first page
+class TopicIndex(db.Model):
+    topic_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    board = db.Column(db.Integer, nullable=False)
+    board_offset = db.Column(db.Integer, nullable=False)
+    last_updated = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, topic_id, board, board_offset, last_updated):
+        self.topic_id = topic_id
+        self.board = board
+        self.board_offset = board_offset
+        self.last_updated = last_updated
+
+    def location(self):
+        return (self.board, self.board_offset, self.last_updated)
+
+
+# how far each board has been synced - the newest last_updated fully processed and the board offset reached
+class CrawlState(db.Model):
+    board = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    watermark = db.Column(db.DateTime)
+    board_offset = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)
+
+    def __init__(self, board, watermark, board_offset, updated_at):
+        self.board = board
+        self.watermark = watermark
+        self.board_offset = board_offset
+        self.updated_at = updated_at
+
+
+# background work requested through the api and executed by the run_worker command
+class Job(db.Model):
+    # at most one waiting copy of a job, so enqueue can insert and let the index reject duplicates
+    __table_args__ = (
+        db.Index(
+            "job_queued_kind_params_key",
+            "kind",
+            "params",
+            unique=True,
+            postgresql_where=db.text("status = 'queued'"),
+        ),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(40), nullable=False)
+    params = db.Column(JSONB, nullable=False, default=dict)
+    status = db.Column(db.String(10), nullable=False, default="queued", index=True)
+    progress = db.Column(JSONB, nullable=False, default=dict)
+    result = db.Column(JSONB)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime)
+    # renewed by the worker running the job, a running job whose heartbeat is older than the lease is requeued
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __init__(self, kind, params, created_at):
+        self.kind = kind
+        self.params = params
+        self.status = "queued"
+        self.progress = {}
+        self.created_at = created_at
+
+
+# per stage timing summary of one crawl run by the worker or the scheduler
+class CrawlRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(40), nullable=False)
+    key = db.Column(db.String(40))
+    job_id = db.Column(db.Integer, db.ForeignKey("job.id"))
+    status = db.Column(db.String(10), nullable=False)
+    started_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=False)
+    summary = db.Column(JSONB, nullable=False, default=dict)
+
+    def __init__(
+        self, kind, key, status, started_at, finished_at, summary, job_id=None
+    ):
+        self.kind = kind
+        self.key = key
+        self.status = status
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self.summary = summary
+        self.job_id = job_id
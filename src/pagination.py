@@ -0,0 +1,167 @@
+import base64
+import json
+import math
+from datetime import datetime
+
+from flask_sqlalchemy.pagination import Pagination
+
+from .extensions import db
+
+
+def encode_cursor(direction, values):
+    values = [
+        value.isoformat() if isinstance(value, datetime) else value for value in values
+    ]
+    payload = json.dumps([direction, values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, key_columns):
+    """
+    Direction and key values of a cursor made by encode_cursor, raises ValueError for anything else
+    """
+    try:
+        payload = json.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        )
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if (
+        not isinstance(payload, list)
+        or len(payload) != 2
+        or payload[0] not in ("next", "prev")
+        or not isinstance(payload[1], list)
+        or len(payload[1]) != len(key_columns)
+    ):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+    direction, values = payload
+    try:
+        decoded = [
+            decode_key(column, value) for column, value in zip(key_columns, values)
+        ]
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    return direction, decoded
+
+
+def decode_key(column, value):
+    """
+    A key value read from a cursor, checked against the type of the column it is compared with
+    """
+    column_type = column.type
+    # bool is an int to python but never a key value
+    if isinstance(value, bool):
+        raise TypeError(f"{value!r} is not a {column_type} key")
+    if isinstance(column_type, db.DateTime):
+        if not isinstance(value, str):
+            raise TypeError(f"{value!r} is not a {column_type} key")
+        value = datetime.fromisoformat(value)
+        # stored times are naive, like the ones encode_cursor writes
+        if value.tzinfo is not None:
+            raise ValueError(f"{value!r} is not a naive {column_type} key")
+        return value
+    if isinstance(column_type, db.Integer):
+        bits = 63 if isinstance(column_type, db.BigInteger) else 31
+        if not isinstance(value, int) or not -(2**bits) <= value < 2**bits:
+            raise TypeError(f"{value!r} is not a {column_type} key")
+        return value
+    if isinstance(column_type, db.Float):
+        if not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise TypeError(f"{value!r} is not a {column_type} key")
+        return float(value)
+    raise TypeError(f"{column_type} columns cannot be cursor keys")
+
+
+def keyset_paginate(query, key_columns, per_page, cursor=None, key_of=None):
+    """
+    One page of query ordered by key_columns descending, resuming after/before the row a cursor points at
+    Seeks through an index on key_columns instead of counting and skipping rows, so deep pages cost the same as the first
+    key_of returns a row's key values, defaults to reading key_columns off the row
+    Returns the rows and page info with next_cursor/prev_cursor, None when there is no such page
+    """
+    if key_of is None:
+        key_of = lambda row: [getattr(row, column.key) for column in key_columns]
+    key = db.tuple_(*key_columns)
+
+    direction, values = "next", None
+    if cursor:
+        direction, values = decode_cursor(cursor, key_columns)
+
+    if direction == "next":
+        if values is not None:
+            query = query.filter(key < tuple(values))
+        query = query.order_by(*[column.desc() for column in key_columns])
+    else:
+        # walk backwards from the cursor and flip the page back into descending order
+        query = query.filter(key > tuple(values))
+        query = query.order_by(*[column.asc() for column in key_columns])
+
+    # one extra row tells whether another page follows
+    rows = query.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == "prev":
+        rows.reverse()
+
+    has_next = more if direction == "next" else values is not None
+    has_prev = values is not None if direction == "next" else more
+    page_info = {
+        "has_next": has_next and bool(rows),
+        "has_prev": has_prev and bool(rows),
+        "next_cursor": (
+            encode_cursor("next", key_of(rows[-1])) if has_next and rows else None
+        ),
+        "prev_cursor": (
+            encode_cursor("prev", key_of(rows[0])) if has_prev and rows else None
+        ),
+    }
+    return rows, page_info
+
+
+class RangePagination(Pagination):
+    """
+    Pages of rows numbered densely from 0, page k holding numbers [(k - 1) * per_page, k * per_page)
+    Each page is a range scan on the number column, so the last page of a thread costs the same as the first
+    reverse counts blocks back from the highest number instead, page k holding
+    (last_number - k * per_page, last_number - (k - 1) * per_page], so page 1 is always the newest per_page rows
+    """
+
+    def _query_items(self):
+        query = self._query_args["query"]
+        number = self._query_args["number"]
+        last_number = self._query_args["last_number"]
+        pages = last_number // self.per_page + 1
+        if not 1 <= self.page <= pages:
+            return []
+
+        if self._query_args["reverse"]:
+            last = last_number - (self.page - 1) * self.per_page
+            return (
+                query.filter(number > last - self.per_page, number <= last)
+                .order_by(number.desc())
+                .all()
+            )
+        first = (self.page - 1) * self.per_page
+        return (
+            query.filter(number >= first, number < first + self.per_page)
+            .order_by(number.asc())
+            .all()
+        )
+
+    def _query_count(self):
+        # every number up to the last one has a slot, a missing row only shortens its page
+        return self._query_args["last_number"] + 1
+
+
+def range_paginate(query, number, last_number, page, per_page, reverse=False):
+    return RangePagination(
+        page=page,
+        per_page=per_page,
+        max_per_page=None,
+        error_out=False,
+        query=query,
+        number=number,
+        last_number=last_number,
+        reverse=reverse,
+    )
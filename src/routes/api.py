@@ -1,11 +1,11 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify
 
-from src.util import process_post, process_post_comments
-from src.scrape.posts import (
-    get_all_post_data,
-    get_page_posts_small_data,
-    get_post_data,
-)
+from src.extensions import db
+from src.models import Job, CrawlRun
+from src.schemas import job_schema, crawl_runs_schema
+from src.jobs import enqueue
+from src.scrape.client import POOL_SIZE
+from src.scrape.metrics import render_prometheus
 
 posts = Blueprint("posts", __name__)
 
@@ -17,7 +17,7 @@ def index():
     return jsonify({"message": "Up and well", "ip": request.remote_addr}), 200
 
 
-# update db by post_type
+# queue a db update by post_type - the run_worker command does the crawl
 @api.route("/update/<post_type>")
 def update(post_type):
     post_type = post_type.upper()
@@ -29,56 +29,60 @@ def update(post_type):
         except Exception as e:
             print(e)
             return jsonify({"message": "Limit is invalid - must be an integer."})
-
-    def scrape_posts_cross_pages(url):
-        stop_processing = False
-        count = 0
-        while not stop_processing:
-            print(f"Begin scraping .{count} (page {(count // 50) + 1})")
-            current_url = f"{url}.{count}"
-            page_small_data = get_page_posts_small_data(current_url)
-
-            for idx, small_post_data in enumerate(page_small_data):
-                print(
-                    f"post: {small_post_data['topic_id']} -- {(count // 50) + 1}.{idx + 1}"
-                )
-                post_data = get_post_data(small_post_data["url"])
-                all_post_data = get_all_post_data(small_post_data, post_data)
-                stop_processing = process_post(all_post_data)
-                # stop_processing = False
-                process_post_comments(all_post_data["topic_id"])
-
-                if limit is not None and (idx + count) >= limit - 1:
-                    print("STOPPING because limit has been reached")
-                    stop_processing = True
-                    break
-                elif limit is None and stop_processing:
-                    print("STOPPING")
-                    stop_processing = True
-                    break
-
-                print("------")
-
-            print(f"Finished scraping .{count} (page {(count // 50) + 1})\n")
-            count += 50
-
-    if post_type == "IC" or post_type == "GB" or post_type == "DB":
-        if post_type == "IC":
-            print("\nWorking on IC\n")
-            url = "https://geekhack.org/index.php?board=132"
-            scrape_posts_cross_pages(url)
-
-        if post_type == "GB":
-            print("\nWorking on GB\n")
-            url = "https://geekhack.org/index.php?board=70"
-            scrape_posts_cross_pages(url)
-
-        if post_type == "DB":
-            update("IC")
-            update("GB")
-    else:
+    workers = request.args.get("workers", None, type=int)
+    if workers is not None and not 1 <= workers <= POOL_SIZE:
+        return (
+            jsonify({"message": f"workers must be between 1 and {POOL_SIZE}"}),
+            400,
+        )
+    # mode=delta only walks the board down to the stored watermark
+    delta = request.args.get("mode", "full").lower() == "delta"
+
+    if post_type != "IC" and post_type != "GB" and post_type != "DB":
         res = jsonify({"message": f"Invalid post_type: {post_type}"})
         res.status_code = 400
         return res
 
-    return jsonify({"message": f"Successfully updated {post_type}."})
+    job = enqueue(
+        "update",
+        {"post_type": post_type, "limit": limit, "workers": workers, "delta": delta},
+    )
+
+    return (
+        jsonify({"message": f"Queued update of {post_type}.", "job_id": job.id}),
+        202,
+    )
+
+
+@api.route("/jobs/<job_id>")
+def get_job(job_id):
+    try:
+        job_id = int(job_id)
+    except ValueError:
+        return jsonify({"error": "Invalid job id - must be an integer"}), 400
+
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return jsonify({"error": f"Job {job_id} does not exist"}), 404
+    return jsonify(
+        {"message": "Successfully received job", "job": job_schema.dump(job)}
+    )
+
+
+# per stage crawl timing histograms of every process, in prometheus text format
+@api.route("/metrics")
+def metrics():
+    return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+# timing summaries of the latest crawls
+@api.route("/crawls")
+def get_crawls():
+    limit = min(request.args.get("limit", 20, type=int), 100)
+    crawl_runs = CrawlRun.query.order_by(CrawlRun.id.desc()).limit(limit).all()
+    return jsonify(
+        {
+            "message": "Successfully received crawls",
+            "crawls": crawl_runs_schema.dump(crawl_runs),
+        }
+    )
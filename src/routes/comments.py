@@ -1,15 +1,21 @@
-from flask import Blueprint, request, jsonify
-from src.models import Comment
+import json
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from src.models import Comment, COMMENTS_PER_PAGE
 from src.schemas import comment_schema, comments_schema
 from src.scrape.comments import (
+    is_final_page,
     scrape_page_comments,
     get_last_page_count,
     scrape_for_specific_comment,
     scrape_all_comments,
     scrape_until,
+    iter_all_comments,
+    iter_until,
 )
+from src.scrape.client import POOL_SIZE
+from src.scrape.crawl import in_crawl, crawl_scope
+from src.jobs import enqueue
 from src.util import (
-    process_post_comments,
     handle_pagination,
     bulk_insert_comments,
     insert_comment,
@@ -17,6 +23,9 @@ from src.util import (
 
 comments = Blueprint("comments", __name__)
 
+# streamed scrapes with add=true commit once this many comments have been sent
+STREAM_COMMIT_EVERY = 500
+
 
 @comments.route("/")
 def index():
@@ -31,13 +40,19 @@ def update_post_comments(post_topic_id):
         return jsonify({"error": "Invalid topic_id type - must be an integer"}), 400
 
     try:
-        process_post_comments(post_topic_id)
+        job = enqueue("update_comments", {"post_topic_id": post_topic_id})
     except Exception as e:
         print(e)
         return jsonify({"error": str(e)}), 500
 
-    return jsonify(
-        {"message": f"Successfully updated comments related to {post_topic_id}"}
+    return (
+        jsonify(
+            {
+                "message": f"Queued update of comments related to {post_topic_id}",
+                "job_id": job.id,
+            }
+        ),
+        202,
     )
 
 
@@ -48,12 +63,22 @@ def update_post_comments(post_topic_id):
 # does not support chaining multiple number identifiers (page, single)
 # does support chaining a number identifier with "add"
 # does support chaining page and limit, from page and to page
+@in_crawl
 def scrape_according_to_parameters(post_topic_id):
     single = request.args.get("single", None, type=int)
     limit = request.args.get("limit", None, type=int)
     to_page = request.args.get("to_page", None, type=int)
     from_page = request.args.get("from_page", 1, type=int)
     add = request.args.get("add", False, type=lambda v: v in ["true", "", "1"])
+    workers = request.args.get("workers", None, type=int)
+    if workers is not None and not 1 <= workers <= POOL_SIZE:
+        return (
+            jsonify({"error": f"workers must be between 1 and {POOL_SIZE}"}),
+            400,
+        )
+    stream = request.args.get(
+        "stream", False, type=lambda v: v in ["true", "", "1"]
+    ) or "application/x-ndjson" in request.headers.get("Accept", "")
 
     # convert page query to list of integers
     page_query = request.args.get("page", "")
@@ -92,26 +117,47 @@ def scrape_according_to_parameters(post_topic_id):
         return result
 
     elif len(pages) > 0:
+        last_page_count = get_last_page_count(post_topic_id)
         for page_num in pages:
             url_count = (page_num - 1) * 50
 
-            last_page_count = get_last_page_count(post_topic_id)
-
             if url_count > last_page_count or url_count < 0:
                 return jsonify({"error": "That comment page does not exist"})
 
             result.extend(
-                scrape_page_comments(post_topic_id, url_count)[
-                    : limit if limit else None
-                ]
+                scrape_page_comments(
+                    post_topic_id,
+                    url_count,
+                    final=is_final_page(url_count, last_page_count),
+                )[: limit if limit else None]
             )
 
+    elif stream:
+        if limit is not None or from_page is not None or to_page is not None:
+            comment_pages = iter_until(
+                post_topic_id,
+                limit=limit,
+                from_page=from_page,
+                to_page=to_page,
+                max_workers=workers,
+            )
+        else:
+            comment_pages = iter_all_comments(post_topic_id, max_workers=workers)
+        return Response(
+            stream_with_context(stream_comments(comment_pages, post_topic_id, add)),
+            mimetype="application/x-ndjson",
+        )
+
     elif limit is not None or from_page is not None or to_page is not None:
         result = scrape_until(
-            post_topic_id, limit=limit, from_page=from_page, to_page=to_page
+            post_topic_id,
+            limit=limit,
+            from_page=from_page,
+            to_page=to_page,
+            max_workers=workers,
         )
     else:
-        result = scrape_all_comments(post_topic_id)
+        result = scrape_all_comments(post_topic_id, max_workers=workers)
 
     if add:
         if isinstance(result, list):
@@ -122,16 +168,41 @@ def scrape_according_to_parameters(post_topic_id):
     return result
 
 
+def stream_comments(comment_pages, post_topic_id, add):
+    """
+    Send every comment as an ndjson line as soon as its page is parsed
+    With add, the sent comments are committed in chunks so memory stays flat however long the thread is
+    """
+    to_insert = []
+    # the response body is produced after the view returns, so it opens its own crawl
+    with crawl_scope():
+        for page_comments in comment_pages:
+            for comment in page_comments:
+                yield json.dumps(comment) + "\n"
+
+            if add:
+                to_insert.extend(page_comments)
+                if len(to_insert) >= STREAM_COMMIT_EVERY:
+                    bulk_insert_comments(to_insert, post_topic_id)
+                    to_insert = []
+
+        if add and to_insert:
+            bulk_insert_comments(to_insert, post_topic_id)
+
+
 @comments.route("/<post_topic_id>")
 # mother endpoint for handling comment querying requests
 # allows to query by post topic id, page number, single comment number, and sort by ascending or descending
-# arguments/queries allowed: single, sort
+# arguments/queries allowed: single, sort, page, limit, reply
+# page k holds reply numbers [(k - 1) * limit, k * limit), with the default limit of 50 these are geekhack's pages
+# reply returns the page holding that reply number instead of page
 # does not support chaining multiple number identifiers (single, sort)
 def from_topic_id(post_topic_id):
     single = request.args.get("single", None, type=int)
     sort_type = request.args.get("sort", "asc", type=str).lower()
     page = request.args.get("page", 1, type=int)
-    limit = request.args.get("limit", 25, type=int)
+    limit = request.args.get("limit", COMMENTS_PER_PAGE, type=int)
+    reply = request.args.get("reply", None, type=int)
 
     try:
         post_topic_id = int(post_topic_id)
@@ -162,12 +233,29 @@ def from_topic_id(post_topic_id):
         if sort_type != "asc" and sort_type != "desc":
             return jsonify({"message": "Invalid sort type"}), 400
 
-        queried_comments = None
+        if limit < 1 or (reply is not None and reply < 0):
+            return (
+                jsonify({"message": "limit must be positive and reply not negative"}),
+                400,
+            )
 
-        queried_comments = (
-            Comment.query.filter_by(post_topic_id=post_topic_id)
-            .order_by(getattr(Comment.created_at, sort_type)())
-            .paginate(page=page, per_page=limit)
+        last_number = Comment.last_number(post_topic_id)
+        if reply is not None:
+            if reply > last_number:
+                return (
+                    jsonify(
+                        {"message": f"#{reply} from {post_topic_id} does not exist."}
+                    ),
+                    404,
+                )
+            page = Comment.page_of(reply, limit, sort_type, last_number)
+
+        queried_comments = Comment.get_page(
+            post_topic_id,
+            page=page,
+            per_page=limit,
+            sort=sort_type,
+            last_number=last_number,
         )
 
         comments = comments_schema.dump(queried_comments.items)
@@ -8,7 +8,14 @@ from src.schemas import (
     images_schema,
 )
 from src.scrape.posts import get_post_data, get_last_page, scrape_single_post
-from src.util import reset_images, handle_pagination, bulk_insert_images
+from src.scrape.crawl import in_crawl
+from src.util import (
+    reset_images,
+    handle_pagination,
+    upsert_posts,
+    get_topic_location,
+    index_board_page,
+)
 
 posts = Blueprint("posts", __name__)
 
@@ -19,6 +26,7 @@ def index():
 
 
 @posts.route("/scrape/<topic_id>")
+@in_crawl
 def scrape_post(topic_id):
     try:
         topic_id = int(topic_id)
@@ -28,31 +36,18 @@ def scrape_post(topic_id):
                 "error": "Could not convert topic_id to an integer. Topic_id must be an integer."
             }
         )
-    post = scrape_single_post(topic_id)
+    post = scrape_single_post(topic_id, get_topic_location(topic_id))
+    if post is None:
+        return jsonify({"error": f"Could not find topic {topic_id} on any board"}), 404
+    index_board_page([post], post["board"], post["board_offset"])
     add = request.args.get("add", False, type=lambda v: v in ["true", "", "1"])
 
     if add:
         print(f'Adding {post["title"]}')
         try:
-            new_db_post = Post(
-                topic_id=post["topic_id"],
-                title=post["title"],
-                url=post["url"],
-                creator=post["creator"],
-                created=post["created"],
-                last_updated=post["last_updated"],
-                post_type=post["post_type"],
-            )
-            db.session.add(new_db_post)
-            db.session.commit()
-
-            bulk_insert_images(new_db_post, post)
-            db.session.commit()
+            upsert_posts([post])
         except SQLAlchemyError as e:
-            db.session.rollback()
-            print(f"Error adding {post['title']}: e")
-        finally:
-            db.session.close()
+            print(f"Error adding {post['title']}: {e}")
 
     return post
 
@@ -67,13 +62,23 @@ def get_posts_by_query():
         return jsonify({"message": "Missing query parameter"}), 400
     limit = request.args.get("limit", 25, type=int)
     page = request.args.get("page", 1, type=int)
+    # cursor mode skips the count and offset, pass an empty cursor for the first page
+    cursor = request.args.get("cursor")
 
-    queried_posts, pagination = Post.get(
-        many=True, page=page, per_page=limit, title=search_query
-    )
+    try:
+        results, pagination = Post.search(
+            search_query, page=page, per_page=limit, cursor=cursor
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    page_info = handle_pagination(pagination)
-    serialized_posts = posts_schema.dump(queried_posts)
+    page_info = pagination if cursor is not None else handle_pagination(pagination)
+    serialized_posts = posts_schema.dump([post for post, *_ in results])
+    for serialized, (_, rank, title_headline, body_headline) in zip(
+        serialized_posts, results
+    ):
+        serialized["rank"] = rank
+        serialized["highlight"] = {"title": title_headline, "body": body_headline}
 
     return jsonify(
         {
@@ -116,11 +121,13 @@ def rescrape_post(topic_id):
 @posts.route("/<post_type>/<sort_type>")
 # post_type -> 'IC' or 'GB' or 'ALL'
 # sort_type -> 'latest' or 'newest'
+# cursor -> next_cursor/prev_cursor of a previous response, or empty for the first page, instead of page
 def get_posts(post_type, sort_type):
     post_type = post_type.upper()
     sort_type = sort_type.lower()
     limit = request.args.get("limit", 25, type=int)
     page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
 
     # check if post_type is valid
     # if it is either IC GB or ALL
@@ -143,27 +150,25 @@ def get_posts(post_type, sort_type):
         return res
 
     # if IC or GB include SQL WHERE on post_type
+    query_options = {}
     if post_type == "IC" or post_type == "GB":
-        queried_posts, pagination = Post.get(
-            many=True,
-            page=page,
-            per_page=limit,
-            order_by=time,
-            order_dir="desc",
-            post_type=post_type,
-        )
+        query_options["post_type"] = post_type
 
     # post_type is ALL so no need to filter
-    else:
+    try:
         queried_posts, pagination = Post.get(
             many=True,
             page=page,
             per_page=limit,
             order_by=time,
             order_dir="desc",
+            cursor=cursor,
+            **query_options,
         )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    page_info = handle_pagination(pagination)
+    page_info = pagination if cursor is not None else handle_pagination(pagination)
 
     res = posts_schema.dump(queried_posts)
 
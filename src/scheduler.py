@@ -0,0 +1,151 @@
+import heapq
+import os
+import random
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from .extensions import db
+from .jobs import enqueue, prune_finished_jobs
+from .models import Post
+from .scrape.posts import BOARDS
+
+# seconds between incremental board syncs
+BOARD_INTERVALS = {
+    "IC": int(os.environ.get("SCHEDULE_IC_INTERVAL", 15 * 60)),
+    "GB": int(os.environ.get("SCHEDULE_GB_INTERVAL", 10 * 60)),
+}
+# comment refresh interval by how recently a thread was active - (max age, interval)
+# threads older than the last tier are left to the board syncs, which pick them up when bumped
+THREAD_TIERS = [
+    (timedelta(days=1), timedelta(minutes=15)),
+    (timedelta(days=7), timedelta(hours=1)),
+    (timedelta(days=30), timedelta(hours=6)),
+]
+# how often the list of active threads is reloaded from the database
+THREAD_RELOAD_INTERVAL = int(os.environ.get("SCHEDULE_THREAD_RELOAD", 30 * 60))
+# how often finished jobs and crawl runs past their retention are deleted
+PRUNE_INTERVAL = int(os.environ.get("SCHEDULE_PRUNE_INTERVAL", 60 * 60))
+# every interval is stretched or shrunk by up to this fraction so runs don't line up
+JITTER = float(os.environ.get("SCHEDULE_JITTER", 0.1))
+
+
+def forum_now():
+    """
+    Current time on geekhack's clock, taken as the latest activity stored from the board syncs
+    Post times are the forum's local time, so ages are measured against them rather than this host's clock
+    """
+    latest = db.session.query(db.func.max(Post.last_updated)).scalar()
+    return latest or datetime.now()
+
+
+def thread_interval(last_updated, now):
+    age = now - last_updated
+    for max_age, interval in THREAD_TIERS:
+        if age <= max_age:
+            return interval.total_seconds()
+    return None
+
+
+class Scheduler:
+    def __init__(self, jitter=JITTER):
+        self.jitter = jitter
+        self.tasks = []
+        self.scheduled_threads = set()
+        self.sequence = 0
+
+    def jittered(self, interval):
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def schedule(self, delay, kind, key=None):
+        self.sequence += 1
+        heapq.heappush(self.tasks, (time.time() + delay, self.sequence, kind, key))
+
+    def start(self):
+        # boards start right away, one after the other
+        for post_type in BOARDS:
+            self.schedule(0, "board", post_type)
+        self.schedule(0, "reload_threads")
+        self.schedule(0, "prune")
+
+    def reload_threads(self):
+        now = forum_now()
+        oldest = now - THREAD_TIERS[-1][0]
+        recent_posts = (
+            db.session.query(Post.topic_id, Post.last_updated)
+            .filter(Post.last_updated >= oldest)
+            .all()
+        )
+        db.session.close()
+
+        for topic_id, last_updated in recent_posts:
+            if topic_id in self.scheduled_threads:
+                continue
+            interval = thread_interval(last_updated, now)
+            if interval is None:
+                continue
+            # spread first refreshes over a whole interval instead of running them all at once
+            self.scheduled_threads.add(topic_id)
+            self.schedule(random.uniform(0, interval), "thread", topic_id)
+        print(f"Scheduler tracking {len(self.scheduled_threads)} active threads")
+        self.schedule(self.jittered(THREAD_RELOAD_INTERVAL), "reload_threads")
+
+    def prune(self):
+        jobs, runs = prune_finished_jobs()
+        print(f"Pruned {jobs} finished jobs and {runs} crawl runs")
+        self.schedule(self.jittered(PRUNE_INTERVAL), "prune")
+
+    def sync_board(self, post_type):
+        job = enqueue("update", {"post_type": post_type, "delta": True})
+        print(f"Scheduled sync of {post_type} as job {job.id}")
+        self.schedule(self.jittered(BOARD_INTERVALS[post_type]), "board", post_type)
+
+    def refresh_thread(self, topic_id):
+        job = enqueue("update_comments", {"post_topic_id": topic_id})
+        print(f"Scheduled comment refresh of {topic_id} as job {job.id}")
+
+        db_post = Post.get(topic_id=topic_id, include_images=False)
+        interval = (
+            thread_interval(db_post.last_updated, forum_now()) if db_post else None
+        )
+        db.session.close()
+        if interval is None:
+            self.scheduled_threads.discard(topic_id)
+            return
+        self.schedule(self.jittered(interval), "thread", topic_id)
+
+    def run_task(self, kind, key):
+        try:
+            if kind == "board":
+                self.sync_board(key)
+            elif kind == "thread":
+                self.refresh_thread(key)
+            elif kind == "reload_threads":
+                self.reload_threads()
+            elif kind == "prune":
+                self.prune()
+        except Exception:
+            db.session.rollback()
+            traceback.print_exc()
+            # a failed task tries again after its normal interval
+            if kind == "board":
+                self.schedule(self.jittered(BOARD_INTERVALS[key]), kind, key)
+            elif kind == "thread":
+                self.schedule(
+                    self.jittered(THREAD_TIERS[0][1].total_seconds()), kind, key
+                )
+            elif kind == "prune":
+                self.schedule(self.jittered(PRUNE_INTERVAL), kind, key)
+            else:
+                self.schedule(self.jittered(THREAD_RELOAD_INTERVAL), kind, key)
+        finally:
+            db.session.close()
+
+    def run_forever(self):
+        self.start()
+        while self.tasks:
+            due, _, kind, key = heapq.heappop(self.tasks)
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.run_task(kind, key)
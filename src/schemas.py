@@ -1,39 +1,12 @@
 from .extensions import ma
 from marshmallow import fields
-from .models import Comment, Post
+from .models import Comment, Post, Job, CrawlRun
 import re
-import json
 from datetime import datetime
 from src.util import handle_pagination
 
 
 class CommentSchema(ma.SQLAlchemyAutoSchema):
-    message = ma.Method("deserialize_message", dump_only=True)
-
-    def de_me(self, message):
-        deserialized = []
-        for item in message:
-            try:
-                item_dict = json.loads(item)
-                for key in item_dict:
-                    if key == "message":
-                        try:
-                            item_dict[key] = self.de_me(item_dict[key])
-                        except Exception as e:
-                            print("ERROR ERROR ERROR")
-                            print(e)
-
-                deserialized.append(item_dict)
-
-            except json.JSONDecodeError:
-                deserialized.append(item)
-        return deserialized
-
-    def deserialize_message(self, comment):
-        deserialized = []
-        deserialized = self.de_me(comment.message)
-        return deserialized
-
     def convert_dict(self, quote_dict):
         deserialized = {}
         for key, value in quote_dict.items():
@@ -108,9 +81,22 @@ class PostSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Post
         include_fk = True
+        exclude = ("search_vector", "body_hash")
+
+
+class JobSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = Job
 
 
-posts_schema = PostSchema(many=True)
+class CrawlRunSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = CrawlRun
+        include_fk = True
+
+
+# listings and search leave the opening post's markup out, it is only served with a single post
+posts_schema = PostSchema(many=True, exclude=("body",))
 post_schema = PostSchema()
 
 images_schema = ImageSchema(many=True)
@@ -118,3 +104,7 @@ image_schema = ImageSchema()
 
 comments_schema = CommentSchema(many=True)
 comment_schema = CommentSchema()
+
+job_schema = JobSchema()
+
+crawl_runs_schema = CrawlRunSchema(many=True)
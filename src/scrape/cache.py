@@ -0,0 +1,223 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from .client import fetch
+from .crawl import current_crawl
+from .metrics import timed
+
+# on-disk cache of geekhack pages sitting under the scrapers
+# bodies are kept on disk, stale entries are revalidated with If-None-Match/If-Modified-Since,
+# and full comment pages (offset before the last page) never change so they never expire
+CACHE_ENABLED = os.environ.get("SCRAPE_CACHE", "1") not in ["0", "false", ""]
+CACHE_DIR = os.environ.get(
+    "SCRAPE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "keytonomy-cache")
+)
+CACHE_MAX_BYTES = int(os.environ.get("SCRAPE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# seconds a page is served without revalidation, per page class
+BOARD_TTL = int(os.environ.get("SCRAPE_CACHE_BOARD_TTL", 30))
+TOPIC_TTL = int(os.environ.get("SCRAPE_CACHE_TOPIC_TTL", 0))
+DEFAULT_TTL = int(os.environ.get("SCRAPE_CACHE_DEFAULT_TTL", 0))
+FOREVER = None
+
+EVICT_EVERY = 100
+_writes = 0
+_writes_lock = threading.Lock()
+
+
+def normalize_url(url):
+    """
+    Drop PHPSESSID and the fragment so the same page always maps to the same key
+    """
+    parts = urlsplit(url)
+    query = [
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.upper() != "PHPSESSID"
+    ]
+    return urlunsplit(
+        (parts.scheme, parts.netloc.lower(), parts.path, urlencode(query), "")
+    )
+
+
+def page_ttl(url, final=False):
+    if final:
+        return FOREVER
+    query = dict(parse_qsl(urlsplit(url).query))
+    if "board" in query:
+        return BOARD_TTL
+    if "topic" in query:
+        return TOPIC_TTL
+    return DEFAULT_TTL
+
+
+def entry_paths(key):
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    directory = os.path.join(CACHE_DIR, digest[:2])
+    return (
+        directory,
+        os.path.join(directory, f"{digest}.body"),
+        os.path.join(directory, f"{digest}.json"),
+    )
+
+
+def read_entry(key):
+    _, body_path, meta_path = entry_paths(key)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        with open(body_path, "rb") as f:
+            body = f.read()
+    except (OSError, ValueError):
+        return None, None
+    if meta.get("url") != key:
+        return None, None
+    return meta, body
+
+
+def write_atomic(path, data):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_entry(key, meta, body=None):
+    global _writes
+    directory, body_path, meta_path = entry_paths(key)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        if body is not None:
+            write_atomic(body_path, body)
+        write_atomic(meta_path, json.dumps(meta).encode())
+    except OSError as e:
+        print(f"Error writing cache entry for {key}: {e}")
+        return
+
+    with _writes_lock:
+        _writes += 1
+        should_evict = _writes % EVICT_EVERY == 0
+    if should_evict:
+        evict()
+
+
+def evict(max_bytes=None):
+    """
+    Delete least recently used entries until the cache is back under 90% of its size limit
+    """
+    max_bytes = max_bytes or CACHE_MAX_BYTES
+    entries = []
+    total = 0
+    for root, _, files in os.walk(CACHE_DIR):
+        for name in files:
+            if not name.endswith(".body"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    if total <= max_bytes:
+        return
+
+    entries.sort()
+    target = max_bytes * 0.9
+    for _, size, path in entries:
+        if total <= target:
+            break
+        for stale_path in (path, path[: -len(".body")] + ".json"):
+            try:
+                os.remove(stale_path)
+            except OSError:
+                pass
+        total -= size
+
+
+def is_fresh(meta, ttl):
+    # only a final fetch is served a final entry without revalidation, and only one stored as final:
+    # the same url read as a page that can change, or stored before the page filled up, is checked again
+    if ttl is FOREVER:
+        return bool(meta.get("final"))
+    return time.time() - meta["fetched_at"] < ttl
+
+
+def fetch_page(url, final=False, session=None):
+    """
+    Return the body of a geekhack page
+    Pages already fetched during the current crawl are reused, then the disk cache is consulted
+    final marks a page whose content can no longer change (a full comment page)
+    session overrides the shared pooled session the page is requested through
+    """
+    key = normalize_url(url)
+    crawl = current_crawl()
+    if crawl is not None:
+        body = crawl.get_page(key)
+        if body is not None:
+            return body
+
+    with timed("fetch"):
+        if CACHE_ENABLED:
+            body = fetch_cached(url, key, final, session)
+        else:
+            body = fetch(url, session=session).content
+
+    # final pages live in the disk cache forever, the crawl memo only needs the pages that can change
+    if crawl is not None and (not final or not CACHE_ENABLED):
+        crawl.put_page(key, body)
+    return body
+
+
+def fetch_cached(url, key, final=False, session=None):
+    ttl = page_ttl(url, final)
+    meta, body = read_entry(key)
+
+    if meta is not None and is_fresh(meta, ttl):
+        _, body_path, _ = entry_paths(key)
+        try:
+            # body mtime doubles as the last access time for eviction
+            os.utime(body_path)
+        except OSError:
+            pass
+        return body
+
+    headers = {}
+    if meta is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    req = fetch(url, session=session, headers=headers)
+
+    if req.status_code == 304 and meta is not None:
+        meta["fetched_at"] = time.time()
+        meta["final"] = meta.get("final") or final
+        write_entry(key, meta)
+        return body
+
+    if req.status_code == 200:
+        write_entry(
+            key,
+            {
+                "url": key,
+                "fetched_at": time.time(),
+                "etag": req.headers.get("ETag"),
+                "last_modified": req.headers.get("Last-Modified"),
+                "final": final,
+            },
+            req.content,
+        )
+    return req.content
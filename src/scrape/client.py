@@ -0,0 +1,115 @@
+import contextvars
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .ratelimit import acquire, record_response, THROTTLED_STATUSES
+
+# every scraper fetch goes through one keep-alive session so geekhack pages reuse
+# pooled connections instead of paying a new TCP+TLS handshake per request
+CONNECT_TIMEOUT = float(os.environ.get("SCRAPE_CONNECT_TIMEOUT", 5))
+READ_TIMEOUT = float(os.environ.get("SCRAPE_READ_TIMEOUT", 20))
+RETRIES = int(os.environ.get("SCRAPE_RETRIES", 3))
+BACKOFF = float(os.environ.get("SCRAPE_BACKOFF", 0.5))
+POOL_SIZE = int(os.environ.get("SCRAPE_POOL_SIZE", 16))
+MAX_WORKERS = int(os.environ.get("SCRAPE_MAX_WORKERS", 8))
+# extra attempts after a 429/503, each one waiting out the rate limiter's pause first
+THROTTLE_RETRIES = int(os.environ.get("SCRAPE_THROTTLE_RETRIES", 3))
+# scrapers keep building canonical geekhack urls, GEEKHACK_URL sends the requests to a stand-in server instead
+GEEKHACK_ORIGIN = "https://geekhack.org"
+GEEKHACK_URL = os.environ.get("GEEKHACK_URL", GEEKHACK_ORIGIN).rstrip("/")
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_session():
+    retry = Retry(
+        total=RETRIES,
+        connect=RETRIES,
+        read=RETRIES,
+        backoff_factor=BACKOFF,
+        # 429/503 are left to fetch so the shared rate limiter sees them
+        status_forcelist=(500, 502, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+        respect_retry_after_header=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate"})
+    return session
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def resolve_url(url):
+    if GEEKHACK_URL != GEEKHACK_ORIGIN and url.startswith(GEEKHACK_ORIGIN):
+        return GEEKHACK_URL + url[len(GEEKHACK_ORIGIN) :]
+    return url
+
+
+def fetch(url, session=None, timeout=None, **kwargs):
+    """
+    GET a url through the shared pooled session, at the pace the host's rate limiter allows
+    5xx responses and connection resets are retried with backoff before giving up
+    429/503 slow the host down for every worker and are retried after Retry-After
+    """
+    session = session or get_session()
+    timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+    url = resolve_url(url)
+    host = urlsplit(url).hostname
+
+    for attempt in range(THROTTLE_RETRIES + 1):
+        acquire(host)
+        req = session.get(url, timeout=timeout, **kwargs)
+        record_response(host, req.status_code, req.headers.get("Retry-After"))
+        if req.status_code not in THROTTLED_STATUSES:
+            break
+    return req
+
+
+def map_concurrently(func, items, max_workers=None):
+    """
+    Run func over items on a bounded thread pool and yield the results in input order
+    At most max_workers calls are in flight, so a slow consumer never piles up results
+    Stopping iteration early cancels the calls that have not started yet
+    """
+    # more threads than pooled connections would only open and drop extra ones
+    max_workers = min(max_workers or MAX_WORKERS, POOL_SIZE)
+    items = iter(items)
+    if max_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = deque()
+    try:
+        for item in items:
+            # each call runs in a copy of the caller's context so it joins the caller's crawl
+            context = contextvars.copy_context()
+            pending.append(executor.submit(context.run, func, item))
+            if len(pending) >= max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
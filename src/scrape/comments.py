@@ -1,5 +1,9 @@
-from bs4 import BeautifulSoup, Tag, NavigableString
-import requests
+from bs4 import Tag, NavigableString
+from .client import map_concurrently
+from .cache import fetch_page
+from .crawl import topic_memo
+from .metrics import labelled, timed
+from .parser import make_soup, run_parser, POST_WRAPPERS, PAGE_LINKS
 import re
 from datetime import datetime
 
@@ -151,13 +155,32 @@ def scrape_comment(wrapper, post_topic_id):
     return comment_info
 
 
+def is_final_page(count, last_page_count):
+    """
+    Whether the comment page at count is full and can no longer change
+    The first page never is, the page links and the opening post are read from the same url
+    """
+    return last_page_count is not None and 0 < count < last_page_count
+
+
 # scrape comment pages
-def scrape_page_comments(topic_id, count):
+# final marks a full page (see is_final_page) that can be served from the cache forever
+def scrape_page_comments(topic_id, count, final=False, session=None):
     url = f"https://geekhack.org/index.php?topic={topic_id}.{count}"
-    req = requests.get(url)
-    soup = BeautifulSoup(req.content, "html5lib")
-    global page_soup
-    page_soup = soup
+    with labelled(topic=topic_id):
+        markup = fetch_page(url, final=final, session=session)
+        with timed("parse"):
+            comments = run_parser(parse_page_comments, markup, topic_id, count)
+
+    topic = topic_memo(topic_id)
+    if comments and count == topic.get("last_page_count"):
+        topic["replies"] = comments[-1]["number"]
+    return comments
+
+
+# parse the comments out of a comment page's html
+def parse_page_comments(markup, topic_id, count, backend=None):
+    soup = make_soup(markup, only=POST_WRAPPERS, backend=backend)
     post_wrappers = soup.find_all("div", class_="post_wrapper")
     if count == 0:
         post_wrappers = post_wrappers[1:]
@@ -165,78 +188,134 @@ def scrape_page_comments(topic_id, count):
     for wrapper in post_wrappers:
         comments.append(scrape_comment(wrapper, topic_id))
 
+    # comments only hold plain strings, so the tree can go as soon as they are extracted
+    soup.decompose()
     return comments
 
 
-def scrape_for_specific_comment(topic_id, comment_number):
+def scrape_for_specific_comment(topic_id, comment_number, session=None):
+    replies = topic_memo(topic_id).get("replies")
+    if replies is not None and comment_number > replies:
+        return None
+
     page = comment_number // 50
     url_count = page * 50
 
-    url = f"https://geekhack.org/index.php?topic={topic_id}.{url_count}"
-    req = requests.get(url)
-    soup = BeautifulSoup(req.content, "html.parser")
+    for comment in scrape_page_comments(topic_id, url_count, session=session):
+        if comment["number"] == comment_number:
+            return comment
+    return None
 
-    tag = soup.find("strong", text=f"Reply #{comment_number} on:")
-    if tag is None:
-        return None
 
-    # .parent -> "smalltext"
-    # x2.parent -> "keyinfo"
-    # x3.parent -> "flow_hidden"
-    # x4.parent -> "postarea"
-    # x5.parent -> "post_wrapper"
-    comment_wrapper = tag.parent.parent.parent.parent.parent
-    return scrape_comment(comment_wrapper, topic_id)
+def get_last_page_count(topic_id, session=None):
+    topic = topic_memo(topic_id)
+    if "last_page_count" not in topic:
+        topic["last_page_count"] = scrape_last_page_count(topic_id, session)
+    return topic["last_page_count"]
 
 
-def get_last_page_count(topic_id):
+def scrape_last_page_count(topic_id, session=None):
     base_url = f"https://geekhack.org/index.php?topic={topic_id}.0"
-    req = requests.get(base_url)
-    soup = BeautifulSoup(req.content, "html.parser")
-
-    # go to last page
-    page_links_container = soup.find("div", class_="pagelinks")
-    nav_pages = page_links_container.find_all("a", class_="navPages")
-    if len(nav_pages) >= 2:
-        return int(nav_pages[-2].get("href").split(".")[-1])
+    with labelled(topic=topic_id):
+        markup = fetch_page(base_url, session=session)
+        with timed("parse"):
+            soup = make_soup(markup, only=PAGE_LINKS)
+            # go to last page
+            page_links_container = soup.find("div", class_="pagelinks")
+            nav_pages = page_links_container.find_all("a", class_="navPages")
+            last_page_href = nav_pages[-2].get("href") if len(nav_pages) >= 2 else None
+            soup.decompose()
+    if last_page_href:
+        return int(last_page_href.split(".")[-1])
     else:
         return 0
 
 
-def scrape_all_comments(topic_id):
-    last_page_count = get_last_page_count(topic_id)
-    url_count = 0
+# scrape several comment pages concurrently, yielding each page's comments in the order of counts
+def scrape_pages_comments(
+    topic_id, counts, max_workers=None, last_page_count=None, session=None
+):
+    def scrape_page(count):
+        final = is_final_page(count, last_page_count)
+        return scrape_page_comments(topic_id, count, final=final, session=session)
+
+    return map_concurrently(
+        scrape_page,
+        counts,
+        max_workers=max_workers,
+    )
+
 
+def iter_all_comments(topic_id, max_workers=None, session=None):
+    """
+    Yield the comments of every page of a topic, one page at a time, as soon as each is parsed
+    """
+    last_page_count = get_last_page_count(topic_id, session)
+    counts = range(0, int(last_page_count) + 1, 50)
+
+    pages = scrape_pages_comments(
+        topic_id, counts, max_workers, last_page_count, session
+    )
+    try:
+        for page_comments in pages:
+            yield page_comments
+    finally:
+        pages.close()
+
+
+def scrape_all_comments(topic_id, max_workers=None, session=None):
     comments = []
-    while url_count <= int(last_page_count):
-        comments.extend(scrape_page_comments(topic_id, url_count))
-        url_count += 50
+    for page_comments in iter_all_comments(topic_id, max_workers, session):
+        comments.extend(page_comments)
 
     return comments
 
 
-def scrape_until(topic_id, limit=None, from_page=1, to_page=None):
-    comments = []
+def iter_until(
+    topic_id, limit=None, from_page=1, to_page=None, max_workers=None, session=None
+):
+    """
+    Yield the comments of pages from_page..to_page one page at a time, stopping once limit comments were yielded
+    """
     total_comments = 0
-    page_count = from_page
 
+    last_page_count = None
     if to_page is not None:
         last_page = to_page
     else:
-        last_page = get_last_page_count(topic_id) // 50 + 1
-
-    while page_count <= last_page:
-        url_count = (page_count - 1) * 50
-        page_comments = scrape_page_comments(topic_id, url_count)
-
-        if limit is not None:
-            if total_comments + len(page_comments) > limit:
-                page_comments = page_comments[: limit - total_comments]
-                comments.extend(page_comments)
-                break
-
+        last_page_count = get_last_page_count(topic_id, session)
+        last_page = last_page_count // 50 + 1
+
+    page_numbers = range(from_page, last_page + 1)
+    if limit is not None:
+        # every page before the last holds at least 49 comments, so there is no need
+        # to fetch more pages than that ahead of time
+        page_numbers = page_numbers[: -(-limit // 49)]
+    counts = [(page_count - 1) * 50 for page_count in page_numbers]
+
+    pages = scrape_pages_comments(
+        topic_id, counts, max_workers, last_page_count, session
+    )
+    try:
+        for page_comments in pages:
+            if limit is not None:
+                if total_comments + len(page_comments) > limit:
+                    yield page_comments[: limit - total_comments]
+                    break
+
+            yield page_comments
+            total_comments += len(page_comments)
+    finally:
+        pages.close()
+
+
+def scrape_until(
+    topic_id, limit=None, from_page=1, to_page=None, max_workers=None, session=None
+):
+    comments = []
+    for page_comments in iter_until(
+        topic_id, limit, from_page, to_page, max_workers, session
+    ):
         comments.extend(page_comments)
-        total_comments += len(page_comments)
-        page_count += 1
 
     return comments
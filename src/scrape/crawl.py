@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+# pages and topic metadata already seen during one crawl (one update, one scrape request)
+# so every distinct url is fetched at most once no matter how many scrapers ask for it
+MEMO_PAGES = int(os.environ.get("SCRAPE_CRAWL_MEMO_PAGES", 256))
+# slowest topics listed in a crawl's summary
+SUMMARY_TOPICS = 20
+
+_current_crawl = ContextVar("current_crawl", default=None)
+
+
+class Crawl:
+    def __init__(self, max_pages=MEMO_PAGES):
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.topics = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # stage -> [count, seconds], overall and per topic
+        self.stages = {}
+        self.topic_stages = {}
+
+    def get_page(self, key):
+        with self.lock:
+            body = self.pages.get(key)
+            if body is not None:
+                self.pages.move_to_end(key)
+            return body
+
+    def put_page(self, key, body):
+        with self.lock:
+            self.pages[key] = body
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+
+    def topic(self, topic_id):
+        """
+        Metadata memo for a topic
+        last_page_count -> offset of the last comment page
+        replies -> number of the last reply, once the last page has been parsed, so later lookups
+                   past it are answered without a fetch
+        """
+        with self.lock:
+            return self.topics.setdefault(int(topic_id), {})
+
+    def record(self, stage, seconds, topic_id=None):
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            if topic_id is not None:
+                stages = self.topic_stages.setdefault(int(topic_id), {})
+                stages[stage] = stages.get(stage, 0.0) + seconds
+
+    def summary(self):
+        """
+        Seconds and calls per stage, plus the topics that took longest
+        """
+        with self.lock:
+            slowest = sorted(
+                self.topic_stages.items(),
+                key=lambda item: sum(item[1].values()),
+                reverse=True,
+            )[:SUMMARY_TOPICS]
+            return {
+                "seconds": time.time() - self.started,
+                "stages": {
+                    stage: {"count": count, "seconds": seconds}
+                    for stage, (count, seconds) in self.stages.items()
+                },
+                "topics_seen": len(self.topic_stages),
+                "slowest_topics": [
+                    {"topic_id": topic_id, "stages": stages}
+                    for topic_id, stages in slowest
+                ],
+            }
+
+
+def current_crawl():
+    return _current_crawl.get()
+
+
+@contextmanager
+def crawl_scope():
+    """
+    Open a crawl for the duration of the block, or join the one already open
+    Threads started through map_concurrently run inside the opening context
+    """
+    crawl = current_crawl()
+    if crawl is not None:
+        yield crawl
+        return
+
+    crawl = Crawl()
+    token = _current_crawl.set(crawl)
+    try:
+        yield crawl
+    finally:
+        _current_crawl.reset(token)
+
+
+def in_crawl(func):
+    """
+    Run every call of func inside a crawl scope
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with crawl_scope():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def topic_memo(topic_id):
+    crawl = current_crawl()
+    if crawl is None:
+        return {}
+    return crawl.topic(topic_id)
@@ -0,0 +1,97 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import CACHE_DIR, write_atomic
+from .client import fetch
+
+# imgur album expansion, cached per album hash on disk and shared by every post that links the album
+# IMGUR_API_URL can point at a local stub of the imgur api
+IMGUR_API_URL = os.environ.get("IMGUR_API_URL", "https://api.imgur.com/3")
+IMGUR_CACHE_TTL = int(os.environ.get("IMGUR_CACHE_TTL", 24 * 60 * 60))
+IMGUR_WORKERS = int(os.environ.get("IMGUR_WORKERS", 4))
+IMGUR_CACHE_DIR = os.path.join(CACHE_DIR, "imgur")
+
+_executor = ThreadPoolExecutor(max_workers=IMGUR_WORKERS)
+_in_flight = {}
+_in_flight_lock = threading.RLock()
+
+
+def album_hash_from_url(url):
+    return url.split("/")[4].split("#")[0].split("?")[0]
+
+
+def is_album_url(href):
+    split = href.split("/")
+    if len(split) >= 5:
+        domain = split[2]
+        a = split[3]
+        return domain == "imgur.com" and a == "a"
+    return False
+
+
+def read_cached_album(album_hash):
+    path = os.path.join(IMGUR_CACHE_DIR, f"{album_hash}.json")
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cached["fetched_at"] > IMGUR_CACHE_TTL:
+        return None
+    return cached["images"]
+
+
+def write_cached_album(album_hash, images):
+    try:
+        os.makedirs(IMGUR_CACHE_DIR, exist_ok=True)
+        write_atomic(
+            os.path.join(IMGUR_CACHE_DIR, f"{album_hash}.json"),
+            json.dumps({"fetched_at": time.time(), "images": images}).encode(),
+        )
+    except OSError as e:
+        print(f"Error caching imgur album {album_hash}: {e}")
+
+
+# image links of an album, None when it could not be fetched
+def scrape_imgur(url):
+    album_hash = album_hash_from_url(url)
+    images = read_cached_album(album_hash)
+    if images is not None:
+        return images
+
+    print(f"Scraping album: {url}")
+    client_id = os.environ["IMGUR_CLIENT_ID"]
+    images = None
+    try:
+        req = fetch(
+            f"{IMGUR_API_URL}/album/{album_hash}/images",
+            headers={"Authorization": f"Client-ID {client_id}"},
+        )
+        images = [image["link"] for image in req.json()["data"]]
+        write_cached_album(album_hash, images)
+    except Exception as e:
+        print(f"\nAn error occurred while making the request\n{url}\n")
+    return images
+
+
+def expand_album(url):
+    """
+    Start expanding an album in the background and return a future of its image links
+    Posts asking for an album that is already being expanded share the same future
+    """
+    album_hash = album_hash_from_url(url)
+    with _in_flight_lock:
+        future = _in_flight.get(album_hash)
+        if future is None:
+            future = _executor.submit(scrape_imgur, url)
+            _in_flight[album_hash] = future
+            future.add_done_callback(lambda _: forget_album(album_hash))
+    return future
+
+
+def forget_album(album_hash):
+    with _in_flight_lock:
+        _in_flight.pop(album_hash, None)
@@ -0,0 +1,199 @@
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from .crawl import current_crawl
+
+# time spent per crawl stage (fetch, parse, db_lookup, db_write, imgur), kept as histograms
+# per (stage, board) for /api/metrics and per topic on the open crawl for its summary
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# every process writes its histograms here so the web process can export the worker's and scheduler's too
+METRICS_DIR = os.environ.get(
+    "METRICS_DIR", os.path.join(tempfile.gettempdir(), "keytonomy-metrics")
+)
+SNAPSHOT_INTERVAL = float(os.environ.get("METRICS_SNAPSHOT_INTERVAL", 10))
+
+_labels = ContextVar("metric_labels", default={})
+# the innermost open timed block of a thread, so nested stages are not counted twice
+_open_timer = threading.local()
+_histograms = {}
+_lock = threading.Lock()
+_snapshot_at = 0
+_snapshot_registered = False
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def to_dict(self):
+        return {"buckets": self.buckets, "count": self.count, "sum": self.sum}
+
+    def merge(self, data):
+        self.buckets = [a + b for a, b in zip(self.buckets, data["buckets"])]
+        self.count += data["count"]
+        self.sum += data["sum"]
+
+
+@contextmanager
+def labelled(**labels):
+    """
+    Attribute every observation inside the block to a board and/or topic
+    Threads started through map_concurrently inherit the labels
+    """
+    token = _labels.set({**_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def observe(stage, seconds):
+    global _snapshot_at
+    labels = _labels.get()
+    board = str(labels.get("board") or "")
+    with _lock:
+        histogram = _histograms.get((stage, board))
+        if histogram is None:
+            histogram = _histograms[(stage, board)] = Histogram()
+        histogram.observe(seconds)
+        should_snapshot = time.monotonic() - _snapshot_at >= SNAPSHOT_INTERVAL
+        if should_snapshot:
+            _snapshot_at = time.monotonic()
+
+    crawl = current_crawl()
+    if crawl is not None:
+        crawl.record(stage, seconds, labels.get("topic"))
+    if should_snapshot:
+        write_snapshot()
+
+
+@contextmanager
+def timed(stage):
+    """
+    Observe the time spent in the block, minus the time of stages timed inside it
+    """
+    parent = getattr(_open_timer, "nested", None)
+    nested = _open_timer.nested = [0.0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _open_timer.nested = parent
+        if parent is not None:
+            parent[0] += elapsed
+        observe(stage, elapsed - nested[0])
+
+
+def snapshot():
+    with _lock:
+        return [
+            {"stage": stage, "board": board, **histogram.to_dict()}
+            for (stage, board), histogram in _histograms.items()
+        ]
+
+
+def snapshot_path(pid):
+    return os.path.join(METRICS_DIR, f"{pid}.json")
+
+
+def write_snapshot():
+    global _snapshot_registered
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = snapshot_path(os.getpid())
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(snapshot(), f)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        print(f"Error writing metrics snapshot: {e}")
+        return
+    if not _snapshot_registered:
+        _snapshot_registered = True
+        atexit.register(remove_snapshot, os.getpid())
+
+
+def remove_snapshot(pid):
+    try:
+        os.remove(snapshot_path(pid))
+    except OSError:
+        pass
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running under another user
+        return True
+    return True
+
+
+def collect():
+    """
+    This process's histograms merged with the last snapshot of every other live process
+    Snapshots left behind by processes that died without cleaning up are removed
+    """
+    merged = {}
+    own = f"{os.getpid()}.json"
+    snapshots = [snapshot()]
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        names = []
+    for name in names:
+        if not name.endswith(".json") or name == own:
+            continue
+        pid = name[: -len(".json")]
+        if not pid.isdigit():
+            continue
+        if not process_alive(int(pid)):
+            remove_snapshot(pid)
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+
+    for entries in snapshots:
+        for entry in entries:
+            key = (entry["stage"], entry["board"])
+            merged.setdefault(key, Histogram()).merge(entry)
+    return merged
+
+
+def render_prometheus():
+    """
+    Histograms in the prometheus text exposition format
+    """
+    name = "keytonomy_crawl_stage_seconds"
+    lines = [
+        f"# HELP {name} Time spent in each crawl stage.",
+        f"# TYPE {name} histogram",
+    ]
+    for (stage, board), histogram in sorted(collect().items()):
+        labels = f'stage="{stage}",board="{board}"'
+        for bound, count in zip(BUCKETS, histogram.buckets):
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+        lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+        lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+    return "\n".join(lines) + "\n"
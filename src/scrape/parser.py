@@ -0,0 +1,101 @@
+import os
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from bs4 import BeautifulSoup, SoupStrainer
+
+# every scraper builds its tree through make_soup so the parser backend can be swapped in one place
+# html5lib repairs broken markup the way browsers do and stays the default until lxml is shown to read
+# real geekhack pages the same way: record some with `flask bench record` and compare them with bench_parsers
+# lxml is by far the fastest bs4 backend; html.parser is the pure python fallback when a backend is missing
+PARSER = os.environ.get("SCRAPE_PARSER", "html5lib")
+BACKENDS = ["lxml", "html.parser", "html5lib"]
+# parsing is pure python CPU work, so with PARSE_PROCESSES > 0 it is shipped to a process pool
+# where pages from many threads/topics spread across cores instead of sharing one GIL
+PARSE_PROCESSES = int(os.environ.get("SCRAPE_PARSE_PROCESSES", 0))
+
+
+def with_class(name):
+    # while parsing, class is still the raw attribute string, so match it word by word
+    def match(value):
+        if not value:
+            return False
+        classes = value.split() if isinstance(value, str) else value
+        return name in classes
+
+    return match
+
+
+# the subtrees each scraper actually reads - everything else on the page is skipped while parsing
+POST_WRAPPERS = SoupStrainer("div", class_=with_class("post_wrapper"))
+OPENING_POST = SoupStrainer("div", class_=with_class("windowbg"))
+BOARD_ROWS = SoupStrainer("tbody")
+PAGE_LINKS = SoupStrainer("div", class_=with_class("pagelinks"))
+
+
+def backend_available(backend):
+    try:
+        if backend == "lxml":
+            import lxml
+        elif backend == "html5lib":
+            import html5lib
+    except ImportError:
+        return False
+    return backend in BACKENDS
+
+
+def available_backends():
+    return [backend for backend in BACKENDS if backend_available(backend)]
+
+
+@lru_cache(maxsize=None)
+def resolve_backend(backend=None):
+    backend = backend or PARSER
+    if not backend_available(backend):
+        print(f"Parser backend {backend} is unavailable, using html.parser")
+        return "html.parser"
+    return backend
+
+
+def make_soup(markup, only=None, backend=None):
+    """
+    Parse markup with the configured backend
+    only is a SoupStrainer limiting the tree to the subtrees a scraper needs
+    html5lib cannot build partial trees, so it always parses the whole page
+    """
+    backend = resolve_backend(backend)
+    if backend == "html5lib":
+        only = None
+    return BeautifulSoup(markup, backend, parse_only=only)
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    global _parse_pool
+    if PARSE_PROCESSES <= 0:
+        return None
+    if _parse_pool is None:
+        with _parse_pool_lock:
+            if _parse_pool is None:
+                # spawn rather than fork, the parent is running fetch threads
+                _parse_pool = ProcessPoolExecutor(
+                    max_workers=PARSE_PROCESSES,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+    return _parse_pool
+
+
+def run_parser(func, *args):
+    """
+    Call a parse function (raw html in, plain dicts out) in the parse pool when one is configured
+    The calling thread waits for the result, so callers already running on fetch threads
+    keep as many parses in flight as they have threads
+    """
+    pool = get_parse_pool()
+    if pool is None:
+        return func(*args)
+    return pool.submit(func, *args).result()
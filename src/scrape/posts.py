@@ -1,9 +1,13 @@
-from bs4 import BeautifulSoup
-import requests
+from .client import map_concurrently
+from .cache import fetch_page
+from .comments import get_last_page_count, scrape_page_comments
+from .imgur import expand_album, is_album_url, album_hash_from_url
+from .metrics import labelled, timed
+from .parser import make_soup, OPENING_POST, BOARD_ROWS, PAGE_LINKS
+import hashlib
 import re
 from datetime import datetime
 from urllib.parse import urlparse, urlsplit, urlunsplit, parse_qs, urlencode
-import os
 
 
 def extract_urls(text):
@@ -14,6 +18,20 @@ def extract_urls(text):
     return ["{}://{}{}".format(*url) for url in urls]
 
 
+BOARDS = {"IC": 132, "GB": 70}
+
+
+def board_url(board, offset=0):
+    return f"https://geekhack.org/index.php?board={board}.{offset}"
+
+
+def board_post_type(board):
+    for post_type, board_num in BOARDS.items():
+        if board_num == int(board):
+            return post_type
+    return ""
+
+
 def uri_validator(parsed_url):
     try:
         return all([parsed_url.scheme, parsed_url.netloc])
@@ -23,9 +41,8 @@ def uri_validator(parsed_url):
 
 # get the last page of a forum
 # input is geekhack url with board query
-def get_last_page(url):
-    req = requests.get(url)
-    soup = BeautifulSoup(req.content, "html.parser")
+def get_last_page(url, session=None):
+    soup = make_soup(fetch_page(url, session=session), only=PAGE_LINKS)
     page_links = soup.find("div", class_="pagelinks floatleft")
     nav_pages = page_links.find_all("a", class_="navPages")
     last_page = nav_pages[-2].text
@@ -34,12 +51,17 @@ def get_last_page(url):
 
 # get all the data on the forum page for each post (data that is exclusive to that page)
 # to do this the whole page much be scrapped as there is no way individually
-def get_page_posts_small_data(url):
+def get_page_posts_small_data(url, session=None):
     """
     Takes in a URL, determines if page is IC or GB by board query
     """
-    req = requests.get(url)
-    soup = BeautifulSoup(req.content, "html.parser")
+    markup = fetch_page(url, session=session)
+    with timed("parse"):
+        return parse_page_posts_small_data(markup, url)
+
+
+def parse_page_posts_small_data(markup, url, backend=None):
+    soup = make_soup(markup, only=BOARD_ROWS, backend=backend)
 
     # determine the type of post by parsing the board number from the URL
     post_type = ""
@@ -71,34 +93,54 @@ def get_page_posts_small_data(url):
 
     # for each post get the url, save topic_id from url, create post_url using topic_id, get last_updated stat as datetime, and append post dictionary containing all this data
     for row in all_posts:
-        subject_column = row.find("td", class_="subject")
-        updated_column = row.find("td", class_="lastpost")
-        # contains /index.php?PHPSESSID=...&topic=...
-        weird_url = subject_column.find("a").get("href")
-        url_parts = re.split("\D+", weird_url)
-        topic_id = url_parts[-2]
-        post_url = f"https://geekhack.org/index.php?topic={topic_id}.0"
-
-        stats_with_author_list = updated_column.text.split()
-        stats_str = " ".join(stats_with_author_list[:5])
-        date_format = "%a, %d %B %Y, %H:%M:%S"
-        date_time_obj = datetime.strptime(stats_str, date_format)
-
-        # create a new dictionary with the relevant data
-        post_small_data = {
-            "url": post_url,
-            "last_updated": date_time_obj,
-            "topic_id": int(topic_id),
-            "post_type": post_type,
-        }
-        small_data.append(post_small_data)
+        small_data.append(parse_board_row(row, post_type))
+    soup.decompose()
     return small_data
 
 
+def parse_board_row(row, post_type):
+    subject_column = row.find("td", class_="subject")
+    updated_column = row.find("td", class_="lastpost")
+    # contains /index.php?PHPSESSID=...&topic=...
+    weird_url = subject_column.find("a").get("href")
+    url_parts = re.split("\D+", weird_url)
+    topic_id = url_parts[-2]
+    post_url = f"https://geekhack.org/index.php?topic={topic_id}.0"
+
+    stats_with_author_list = updated_column.text.split()
+    stats_str = " ".join(stats_with_author_list[:5])
+    date_format = "%a, %d %B %Y, %H:%M:%S"
+    date_time_obj = datetime.strptime(stats_str, date_format)
+
+    # create a new dictionary with the relevant data
+    return {
+        "url": post_url,
+        "last_updated": date_time_obj,
+        "topic_id": int(topic_id),
+        "post_type": post_type,
+    }
+
+
 # given a post's url, get the data for that post
-def get_post_data(url):
-    req = requests.get(url)
-    soup = BeautifulSoup(req.content, "html.parser")
+# body_hash is the hash of the stored opening post, images are left out when it has not changed
+def get_post_data(url, body_hash=None, session=None):
+    topic = parse_qs(urlsplit(url).query).get("topic", [""])[0].split(".")[0]
+    with labelled(topic=topic or None):
+        markup = fetch_page(url, session=session)
+        with timed("parse"):
+            return parse_post_data(markup, body_hash=body_hash)
+
+
+def hash_body(body):
+    # guests get a fresh PHPSESSID in every link, which would change the hash on every fetch
+    body = re.sub(r"PHPSESSID=[0-9a-fA-F]+(&amp;|&|;)?", "", body)
+    return hashlib.sha1(body.encode()).hexdigest()
+
+
+# parse the opening post out of a topic page's html
+# images is None when the body still matches body_hash
+def parse_post_data(markup, backend=None, body_hash=None):
+    soup = make_soup(markup, only=OPENING_POST, backend=backend)
 
     # find the first div element with class 'windowbg'
     # post is always windowbg while the comments alternate windowbg and windowbg2
@@ -124,6 +166,28 @@ def get_post_data(url):
     date_format = "%a, %d %B %Y, %H:%M:%S"
     date_time_obj = datetime.strptime(created_str, date_format)
 
+    all_data = {
+        "title": post_title,
+        "creator": post_creator,
+        "created": date_time_obj,
+        "images": None,
+        "body": str(body),
+        "body_hash": hash_body(str(body)),
+    }
+    # the opening post is unchanged since it was stored, so are its images and albums
+    if body_hash is not None and all_data["body_hash"] == body_hash:
+        soup.decompose()
+        return all_data
+
+    # imgur albums are expanded in the background while the rest of the post is parsed
+    albums = []
+    album_hashes = set()
+    for link in post_container.find_all("a"):
+        href = link.get("href") or ""
+        if is_album_url(href) and album_hash_from_url(href) not in album_hashes:
+            album_hashes.add(album_hash_from_url(href))
+            albums.append(expand_album(href))
+
     post_images = []
     images = post_container.find_all("img")
     for image in images:
@@ -156,97 +220,169 @@ def get_post_data(url):
         else:
             post_images.append(image_url)
 
+    soup.decompose()
     offsite_images = []
-    links = post_container.find_all("a")
-    for link in links:
-        href = link.get("href")
-        split = href.split("/")
-        if len(split) >= 4:
-            domain = split[2]
-            a = split[3]
-            # if url is imgur album
-            if domain == "imgur.com" and a == "a":
-                imgur_images = scrape_imgur(href)
-                offsite_images.extend(imgur_images)
+    with timed("imgur"):
+        for album in albums:
+            images = album.result()
+            if images is None:
+                # keep the post from looking unchanged, so the next crawl expands its albums again
+                all_data["body_hash"] = None
+                continue
+            offsite_images.extend(images)
     post_images.extend(offsite_images)
 
-    all_data = {
-        "title": post_title,
-        "creator": post_creator,
-        "created": date_time_obj,
-        "images": post_images,
-        "body": str(body),
-    }
-
+    all_data["images"] = post_images
     return all_data
 
 
+# fetch and parse many post pages concurrently, yielding their data in the same order as urls
+# body_hashes maps a url to the stored hash of its opening post
+def get_posts_data(urls, max_workers=None, body_hashes=None, session=None):
+    body_hashes = body_hashes or {}
+    return map_concurrently(
+        lambda url: get_post_data(url, body_hashes.get(url), session),
+        urls,
+        max_workers=max_workers,
+    )
+
+
 # given both small and regular post data, combine them to have all data for that post
 def get_all_post_data(small_data, post_data):
     combined = small_data | post_data
     return combined
 
 
-def scrape_single_post(topic_id):
-    url_count = 0
-    last_page = get_last_page("https://geekhack.org/index.php?board=132.0")
-    post_wrapper = None
-    i = 1
-
-    while post_wrapper is None and i <= int(last_page):
-        print(f"searching for {topic_id} in {i} of {last_page}")
-        current_url = f"https://geekhack.org/index.php?board=132.{url_count}"
-        req = requests.get(current_url)
-        soup = BeautifulSoup(req.content, "html.parser")
-        links = soup.find_all("a")
-
-        for link in links:
-            href = link.get("href")
-            if href:
-                url = urlparse(href)
-                params = parse_qs(url.query)
-                if "topic" in params and f"{topic_id}.0" in params["topic"]:
-                    if not url.fragment:
-                        # .parent -> span#msg
-                        # x2.parent -> div
-                        # x3.parent -> div.subject
-                        # x4.parent -> tr
-                        post_wrapper = link.parent.parent.parent.parent
-                        break
-        url_count += 50
-        i += 1
-
-    subject_column = post_wrapper.find("td", class_="subject")
-    updated_column = post_wrapper.find("td", class_="lastpost")
-    # contains /index.php?PHPSESSID=...&topic=...
-    post_url = f"https://geekhack.org/index.php?topic={topic_id}.0"
+def read_board_page(board, offset, session=None):
+    """
+    Every row of a board page, stickies included, each with its board and board_offset
+    Returns all rows and the non-sticky ones, which are the rows ordered by last_updated
+    """
+    markup = fetch_page(board_url(board, offset), session=session)
+    with timed("parse"):
+        soup = make_soup(markup, only=BOARD_ROWS)
+        rows = []
+        ordered = []
+        for row in soup.select("tbody tr:not(.whos_viewing)"):
+            subject_column = row.find("td", class_="subject")
+            if subject_column is None or subject_column.find("a") is None:
+                continue
+            post_small_data = parse_board_row(row, board_post_type(board))
+            post_small_data["board"] = board
+            post_small_data["board_offset"] = offset
+            rows.append(post_small_data)
+            if row.select_one("td.stickybg, td.stickybg2") is None:
+                ordered.append(post_small_data)
+        soup.decompose()
+    return rows, ordered
+
+
+def find_topic_in_rows(topic_id, rows):
+    for post_small_data in rows:
+        if post_small_data["topic_id"] == int(topic_id):
+            return post_small_data
+    return None
+
+
+# find a topic's row on one board page, stickies included
+def find_topic_on_board_page(topic_id, board, offset, session=None):
+    rows, _ = read_board_page(board, offset, session)
+    return find_topic_in_rows(topic_id, rows)
+
+
+def search_board(topic_id, board, last_updated, session=None):
+    """
+    Binary search a board's pages for a topic
+    Boards are ordered by last_updated, newest first, so last_updated decides which half to keep
+    Each probed page is fetched and parsed once, for the topic and for the bisection alike
+    """
+    last_page = int(get_last_page(board_url(board), session))
+    low, high = 0, last_page - 1
+
+    while low <= high:
+        page = (low + high) // 2
+        offset = page * 50
+        print(f"searching for {topic_id} in {page + 1} of {last_page}")
+        rows, ordered = read_board_page(board, offset, session)
+        post_small_data = find_topic_in_rows(topic_id, rows)
+        if post_small_data:
+            return post_small_data
+
+        if not ordered or last_updated > ordered[0]["last_updated"]:
+            high = page - 1
+        elif last_updated < ordered[-1]["last_updated"]:
+            low = page + 1
+        else:
+            # the page covers last_updated but the topic was bumped across a page boundary
+            for neighbour in (page - 1, page + 1):
+                if 0 <= neighbour < last_page:
+                    post_small_data = find_topic_on_board_page(
+                        topic_id, board, neighbour * 50, session
+                    )
+                    if post_small_data:
+                        return post_small_data
+            return None
+    return None
+
+
+# the time of a topic's latest reply, which is what its board row is sorted by
+def get_topic_last_updated(topic_id, session=None):
+    last_page_count = get_last_page_count(topic_id, session)
+    comments = scrape_page_comments(topic_id, last_page_count, session=session)
+    if comments:
+        return datetime.fromisoformat(comments[-1]["created_at"])
+    post_data = get_post_data(
+        f"https://geekhack.org/index.php?topic={topic_id}.0", session=session
+    )
+    return post_data["created"] if post_data else None
 
-    stats_with_author_list = updated_column.text.split()
-    stats_str = " ".join(stats_with_author_list[:5])
-    date_format = "%a, %d %B %Y, %H:%M:%S"
-    date_time_obj = datetime.strptime(stats_str, date_format)
-    post_small_data = {
-        "url": post_url,
-        "last_updated": date_time_obj,
-        "topic_id": int(topic_id),
-        "post_type": "IC",
-    }
-    post_page_data = get_post_data(post_url)
 
-    return get_all_post_data(post_small_data, post_page_data)
+def search_boards(topic_id, boards, last_updated, session=None):
+    for board in boards:
+        post_small_data = search_board(topic_id, board, last_updated, session)
+        if post_small_data:
+            return post_small_data
+    return None
 
 
-def scrape_imgur(url):
-    print(f"Scraping album: {url}")
-    album_hash = url.split("/")[4]
-    client_id = os.environ["IMGUR_CLIENT_ID"]
-    images = []
-    try:
-        req = requests.get(
-            f"https://api.imgur.com/3/album/{album_hash}/images",
-            headers={"Authorization": f"Client-ID {client_id}"},
-        )
-        images = [image["link"] for image in req.json()["data"]]
-    except Exception as e:
-        print(f"\nAn error occurred while making the request\n{url}\n")
-    return images
+def locate_topic(topic_id, location=None, session=None):
+    """
+    Find a topic's board row
+    location is a (board, board_offset, last_updated) hint from the topic index; any part may be None
+    The hinted page is tried first, then each board is binary searched by last_updated
+    A hinted last_updated may be stale since the topic can have been bumped, so when the hinted page
+    misses or the search with it fails, the boards are searched again with the topic's current last_updated
+    """
+    board, offset, last_updated = location or (None, None, None)
+
+    if board is not None and offset is not None:
+        post_small_data = find_topic_on_board_page(topic_id, board, offset, session)
+        if post_small_data:
+            return post_small_data
+        # the topic left the page it was indexed on, so it was bumped after last_updated
+        last_updated = None
+
+    boards = list(BOARDS.values())
+    if board in boards:
+        boards.remove(board)
+        boards.insert(0, board)
+
+    if last_updated is not None:
+        post_small_data = search_boards(topic_id, boards, last_updated, session)
+        if post_small_data:
+            return post_small_data
+
+    current_last_updated = get_topic_last_updated(topic_id, session)
+    if current_last_updated is None or current_last_updated == last_updated:
+        return None
+    return search_boards(topic_id, boards, current_last_updated, session)
+
+
+def scrape_single_post(topic_id, location=None, session=None):
+    post_small_data = locate_topic(topic_id, location, session)
+    if post_small_data is None:
+        return None
+
+    post_page_data = get_post_data(post_small_data["url"], session=session)
+
+    return get_all_post_data(post_small_data, post_page_data)
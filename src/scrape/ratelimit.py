@@ -0,0 +1,115 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on this platform - the bucket is then only shared between threads
+    fcntl = None
+
+# token bucket per host shared by every thread and process through small state files,
+# so concurrent fetches from web workers, the job worker and the scheduler stay polite together
+RATE = float(os.environ.get("SCRAPE_RATE", 4))
+BURST = float(os.environ.get("SCRAPE_BURST", 8))
+MIN_RATE = float(os.environ.get("SCRAPE_MIN_RATE", 0.25))
+# how long to back off after a 429/503 that did not say for how long
+THROTTLE_BACKOFF = float(os.environ.get("SCRAPE_THROTTLE_BACKOFF", 10))
+RATE_LIMIT_DIR = os.environ.get(
+    "SCRAPE_RATE_LIMIT_DIR", os.path.join(tempfile.gettempdir(), "keytonomy-ratelimit")
+)
+THROTTLED_STATUSES = (429, 503)
+
+_thread_lock = threading.Lock()
+
+
+@contextmanager
+def host_state(host):
+    """
+    Load, lock and save the bucket of a host
+    """
+    os.makedirs(RATE_LIMIT_DIR, exist_ok=True)
+    path = os.path.join(RATE_LIMIT_DIR, f"{host}.json")
+    with _thread_lock, open(path, "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                state = json.loads(f.read())
+            except ValueError:
+                state = {}
+            now = time.time()
+            state.setdefault("tokens", BURST)
+            state.setdefault("updated", now)
+            state.setdefault("rate", RATE)
+            state.setdefault("blocked_until", 0)
+
+            # refill for the time passed since the last request
+            elapsed = max(now - state["updated"], 0)
+            state["tokens"] = min(BURST, state["tokens"] + elapsed * state["rate"])
+            state["updated"] = now
+
+            yield state
+
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+            f.flush()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def acquire(host):
+    """
+    Block until the host's bucket has a token to spend
+    """
+    while True:
+        with host_state(host) as state:
+            now = time.time()
+            if now < state["blocked_until"]:
+                wait = state["blocked_until"] - now
+            elif state["tokens"] >= 1:
+                state["tokens"] -= 1
+                return
+            else:
+                wait = (1 - state["tokens"]) / state["rate"]
+        time.sleep(wait)
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def record_response(host, status_code, retry_after=None):
+    """
+    Adjust the host's rate from a response
+    429/503 halve the rate and pause the host for Retry-After, anything else slowly recovers it
+    """
+    with host_state(host) as state:
+        if status_code in THROTTLED_STATUSES:
+            pause = parse_retry_after(retry_after)
+            if pause is None:
+                pause = THROTTLE_BACKOFF
+            state["rate"] = max(MIN_RATE, state["rate"] / 2)
+            state["tokens"] = 0
+            state["blocked_until"] = max(state["blocked_until"], time.time() + pause)
+            print(
+                f"Throttled by {host}, pausing {pause:.0f}s at {state['rate']:.2f} req/s"
+            )
+        elif state["rate"] < RATE:
+            state["rate"] = min(RATE, state["rate"] + RATE * 0.05)
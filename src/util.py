@@ -1,17 +1,25 @@
-from .models import Post, Image, Comment
+from .models import Post, Image, Comment, TopicIndex, CrawlState, CrawlRun
 from .extensions import db
 from .scrape.posts import (
     get_last_page,
     get_page_posts_small_data,
     get_post_data,
+    get_posts_data,
     get_all_post_data,
+    board_url,
+    board_post_type,
+    BOARDS,
 )
-from .scrape.comments import (
-    get_last_page_count,
-    scrape_page_comments,
-)
+from .scrape.comments import get_last_page_count, scrape_pages_comments
+from .scrape.crawl import topic_memo
+from .scrape.metrics import labelled, timed, write_snapshot
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.dialects.postgresql import insert
 from datetime import datetime
+import os
+
+# pages of comments held before each commit when syncing a thread
+COMMENT_CHUNK_PAGES = int(os.environ.get("COMMENT_CHUNK_PAGES", 10))
 
 
 def handle_pagination(pagination):
@@ -44,172 +52,484 @@ def bulk_insert_images(db_post, post_all_data):
     db.session.bulk_save_objects(new_images)
 
 
+def comment_row(comment_data, post_topic_id):
+    return {
+        "message_id": comment_data["comment_id"],
+        "post_topic_id": post_topic_id,
+        "number": comment_data["number"],
+        "link": comment_data["link"],
+        "commenter": comment_data["commenter"],
+        "message": comment_data["message"],
+        "is_starter": comment_data["is_starter"],
+        "attachment": comment_data["attachment"],
+        "created_at": comment_data["created_at"],
+    }
+
+
+def ingest_comments(comments, post_topic_id):
+    """
+    Insert scraped comments through multi-row INSERTs, skipping reply numbers already stored
+    Safe to run any number of times over the same pages - returns how many comments were new
+    """
+    if not comments:
+        return 0
+    statement = (
+        insert(Comment)
+        .on_conflict_do_nothing(index_elements=[Comment.post_topic_id, Comment.number])
+        .returning(Comment.id)
+    )
+    rows = [comment_row(comment_data, post_topic_id) for comment_data in comments]
+    with timed("db_write"):
+        inserted = len(db.session.execute(statement, rows).all())
+        db.session.commit()
+    return inserted
+
+
 def bulk_insert_comments(comments, post_topic_id):
     try:
-        new_comments = [
-            Comment(
-                comment_id=comment_data["comment_id"],
-                post_topic_id=post_topic_id,
-                number=comment_data["number"],
-                link=comment_data["link"],
-                commenter=comment_data["commenter"],
-                message=comment_data["message"],
-                is_starter=comment_data["is_starter"],
-                attachment=comment_data["attachment"],
-                created_at=comment_data["created_at"],
-            )
-            for comment_data in comments
-        ]
-        db.session.bulk_save_objects(new_comments)
-        db.session.commit()
+        return ingest_comments(comments, post_topic_id)
     except SQLAlchemyError as e:
         db.session.rollback()
+        print(f"Error inserting comments of {post_topic_id}: {e}")
+        return 0
     finally:
         db.session.close()
 
 
 def insert_comment(comment_data, post_topic_id):
-    try:
-        new_db_comment = Comment(
-            comment_id=comment_data["comment_id"],
-            post_topic_id=post_topic_id,
-            number=comment_data["number"],
-            link=comment_data["link"],
-            commenter=comment_data["commenter"],
-            message=comment_data["message"],
-            is_starter=comment_data["is_starter"],
-            attachment=comment_data["attachment"],
-            created_at=comment_data["created_at"],
-        )
-        db.session.add(new_db_comment)
-        db.session.commit()
-    except SQLAlchemyError as e:
-        db.session.rollback()
-    finally:
-        db.session.close()
+    return bulk_insert_comments([comment_data], post_topic_id)
 
 
 def reset_images(db_post, post_all_data):
     print("resetting images")
-    # Delete existing images in bulk
-    Image.query.filter_by(post_topic_id=db_post.topic_id).delete()
-    db.session.commit()
-    # Bulk insert new images
-    bulk_insert_images(db_post, post_all_data)
+    reconcile_images({db_post.topic_id: post_all_data["images"]})
     db.session.commit()
 
 
-def process_post(post_all_data):
+def reconcile_images(images_by_topic):
+    """
+    Bring the stored images of each topic in line with its scraped image urls
+    Rows whose url is still there are kept (and reordered if needed), only the difference is inserted or deleted
+    Does not commit
     """
-    Check if post exists in db
-    If post exists -> compare post.last_updated to db post.last_updated
-      matches -> return True
-      doesn't match -> update db post and reset it's images
-    post doesn't exist -> add into db along with its images
+    if not images_by_topic:
+        return
+    stored = {}
+    for image_id, topic_id, image_url, order in db.session.execute(
+        db.select(Image.id, Image.post_topic_id, Image.image_url, Image.order)
+        .where(Image.post_topic_id.in_(list(images_by_topic)))
+        .order_by(Image.order)
+    ):
+        stored.setdefault((topic_id, image_url), []).append((image_id, order))
+
+    reordered = []
+    new_rows = []
+    for topic_id, image_urls in images_by_topic.items():
+        for order, image_url in enumerate(image_urls):
+            rows = stored.get((topic_id, image_url))
+            if not rows:
+                new_rows.append(
+                    {"image_url": image_url, "order": order, "post_topic_id": topic_id}
+                )
+                continue
+            image_id, stored_order = rows.pop(0)
+            if stored_order != order:
+                reordered.append({"id": image_id, "order": order})
+    removed = [image_id for rows in stored.values() for image_id, _ in rows]
+
+    if removed:
+        db.session.execute(db.delete(Image).where(Image.id.in_(removed)))
+    if reordered:
+        db.session.execute(db.update(Image), reordered)
+    if new_rows:
+        db.session.execute(insert(Image).values(new_rows))
+
+
+def upsert_posts(posts_all_data):
     """
-    post_topic_id = int(post_all_data["topic_id"])
-    post_time = post_all_data["last_updated"]
+    Insert new posts and update changed ones, with their images, in one transaction
+    A stored post only counts as changed when its last_updated differs
+    Images are diffed against the stored ones, and left alone when the opening post's body is unchanged
+    Returns the topic ids that were inserted or updated
+    """
+    if not posts_all_data:
+        return set()
+    # a topic bumped between board pages can show up twice, keep its newest row
+    rows = {}
+    for post_all_data in posts_all_data:
+        rows[int(post_all_data["topic_id"])] = {
+            "topic_id": int(post_all_data["topic_id"]),
+            "title": post_all_data["title"],
+            "url": post_all_data["url"],
+            "creator": post_all_data["creator"],
+            "created": post_all_data["created"],
+            "last_updated": post_all_data["last_updated"],
+            "post_type": post_all_data["post_type"],
+            "body": post_all_data.get("body"),
+            "body_hash": post_all_data.get("body_hash"),
+        }
+    # images is None when the scraper saw the stored body hash and skipped extracting them
+    images = {
+        int(post_all_data["topic_id"]): post_all_data["images"]
+        for post_all_data in posts_all_data
+        if post_all_data.get("images") is not None
+    }
 
-    print(f"checking {post_all_data['title']}")
-    db_post = Post.get(topic_id=int(post_topic_id))
-    # checking to see if post exists in database
-    if db_post:
-        db_post_time = db_post.last_updated
-        if db_post_time == post_time and db_post.topic_id == post_topic_id:
-            print("FOUND POST MATCH")
-            return True
-        else:
-            print("updating ^")
-            try:
-                updated_db_post = update_post(db_post, post_all_data)
-                # We want to reset the images everytime a post needs to be updated because what if a post previously had 5 images but the designer decided to update all 5 images with better renderings
-                reset_images(updated_db_post, post_all_data)
-                db.session.commit()
-            except SQLAlchemyError as e:
-                db.session.rollback()
-                print(f"Error updating {post_all_data['title']}: {e}")
-            finally:
-                db.session.close()
-
-    else:
-        # add post with its images
-        print("adding ^")
-        try:
-            new_db_post = Post(
-                topic_id=post_all_data["topic_id"],
-                title=post_all_data["title"],
-                url=post_all_data["url"],
-                creator=post_all_data["creator"],
-                created=post_all_data["created"],
-                last_updated=post_all_data["last_updated"],
-                post_type=post_all_data["post_type"],
+    statement = insert(Post).values(list(rows.values()))
+    statement = statement.on_conflict_do_update(
+        index_elements=[Post.topic_id],
+        set_={
+            "title": statement.excluded.title,
+            "url": statement.excluded.url,
+            "creator": statement.excluded.creator,
+            "created": statement.excluded.created,
+            "last_updated": statement.excluded.last_updated,
+            "post_type": statement.excluded.post_type,
+            "body": statement.excluded.body,
+            "body_hash": statement.excluded.body_hash,
+        },
+        where=Post.last_updated.is_distinct_from(statement.excluded.last_updated),
+    ).returning(Post.topic_id)
+
+    try:
+        with timed("db_write"):
+            changed = {topic_id for (topic_id,) in db.session.execute(statement)}
+            reconcile_images(
+                {
+                    topic_id: image_urls
+                    for topic_id, image_urls in images.items()
+                    if topic_id in changed
+                }
             )
-            db.session.add(new_db_post)
             db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"Error upserting posts {sorted(rows)}: {e}")
+        raise
+    finally:
+        db.session.close()
+    return changed
+
 
-            bulk_insert_images(new_db_post, post_all_data)
+def index_board_page(small_page_data, board, board_offset):
+    """
+    Record where every topic on a board page currently sits
+    """
+    if not small_page_data:
+        return
+    rows = [
+        {
+            "topic_id": small_post_data["topic_id"],
+            "board": board,
+            "board_offset": board_offset,
+            "last_updated": small_post_data["last_updated"],
+        }
+        for small_post_data in small_page_data
+    ]
+    statement = insert(TopicIndex).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[TopicIndex.topic_id],
+        set_={
+            "board": statement.excluded.board,
+            "board_offset": statement.excluded.board_offset,
+            "last_updated": statement.excluded.last_updated,
+        },
+    )
+    try:
+        with timed("db_write"):
+            db.session.execute(statement)
             db.session.commit()
-        except SQLAlchemyError as e:
-            db.session.rollback()
-            print(f"Error adding {post_all_data['title']}: {e}")
-        finally:
-            db.session.close()
-    return False
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"Error indexing board {board}.{board_offset}: {e}")
 
 
-def process_post_comments(topic_id):
-    try:
-        # get the last page count
+def prefetch_board_page(small_page_data):
+    """
+    What the database holds for every topic of a board page, in one query
+    topic_id -> last_updated, body_hash and latest_comment (0 when none is stored)
+    """
+    topic_ids = [small_post_data["topic_id"] for small_post_data in small_page_data]
+    if not topic_ids:
+        return {}
+    latest_comment = (
+        db.select(db.func.max(Comment.number))
+        .where(Comment.post_topic_id == Post.topic_id)
+        .correlate(Post)
+        .scalar_subquery()
+    )
+    with timed("db_lookup"):
+        rows = db.session.execute(
+            db.select(
+                Post.topic_id,
+                Post.last_updated,
+                Post.body_hash,
+                db.func.coalesce(latest_comment, 0),
+            ).where(Post.topic_id.in_(topic_ids))
+        ).all()
+    return {
+        topic_id: {
+            "last_updated": last_updated,
+            "body_hash": body_hash,
+            "latest_comment": latest_number,
+        }
+        for topic_id, last_updated, body_hash, latest_number in rows
+    }
+
+
+def get_topic_location(topic_id):
+    """
+    Best known (board, board_offset, last_updated) for a topic, from the index or the stored post
+    """
+    with timed("db_lookup"):
+        indexed = db.session.get(TopicIndex, topic_id)
+        if indexed:
+            return indexed.location()
+        db_post = Post.get(topic_id=topic_id, include_images=False)
+    if db_post:
+        return (BOARDS.get(db_post.post_type), None, db_post.last_updated)
+    return None
+
+
+def process_post(post_all_data):
+    """
+    Insert or update a single post and its images
+    Returns True when the stored post already had the same last_updated
+    """
+    print(f"checking {post_all_data['title']}")
+    changed = upsert_posts([post_all_data])
+    if int(post_all_data["topic_id"]) in changed:
+        print("added or updated ^")
+        return False
+    print("FOUND POST MATCH")
+    return True
+
+
+def process_post_comments(
+    topic_id, latest_number=None, chunk_pages=None, max_workers=None
+):
+    """
+    Store the replies newer than the latest stored one
+    Pages are walked forward from the one holding the next reply and committed every chunk_pages pages,
+    so memory stays flat however long the thread is and an interrupted sync resumes where it stopped
+    latest_number is the latest stored reply number when the caller already knows it (0 for none)
+    """
+    chunk_pages = chunk_pages or COMMENT_CHUNK_PAGES
+    with labelled(topic=topic_id):
+        if latest_number is None:
+            with timed("db_lookup"):
+                latest_number = (
+                    db.session.query(db.func.max(Comment.number))
+                    .filter(Comment.post_topic_id == topic_id)
+                    .scalar()
+                ) or 0
+
+        # the last page was already parsed during this crawl, nothing newer can be on the forum
+        replies = topic_memo(topic_id).get("replies")
+        if replies is not None and replies <= latest_number:
+            print(f"No new comments past #{latest_number}")
+            return 0
+
         last_page_count = get_last_page_count(topic_id)
 
-        print(f"Begin Processing Comments")
+        # page offsets follow reply numbers, reply n sits on the page at offset n // 50 * 50
+        first_page_count = (latest_number + 1) // 50 * 50
+        counts = range(first_page_count, last_page_count + 1, 50)
+        print(f"Begin Processing Comments .{first_page_count} to .{last_page_count}")
+
+        inserted = 0
+        pending = []
+        for pages, page_comments in enumerate(
+            scrape_pages_comments(
+                topic_id,
+                counts,
+                max_workers=max_workers,
+                last_page_count=last_page_count,
+            ),
+            start=1,
+        ):
+            pending.extend(
+                comment
+                for comment in page_comments
+                if comment["number"] > latest_number
+            )
+            if pages % chunk_pages == 0:
+                inserted += ingest_comments(pending, topic_id)
+                pending = []
+        inserted += ingest_comments(pending, topic_id)
+        print(f"Stored {inserted} new comments")
+        return inserted
+
 
-        # get lastest comment
-        queried_comment = (
-            Comment.query.filter_by(post_topic_id=topic_id)
-            .order_by(Comment.number.desc())
-            .first()
+def get_watermark(board):
+    """
+    Newest last_updated fully processed for a board
+    Falls back to the newest stored post when the board has never been delta synced
+    """
+    with timed("db_lookup"):
+        state = db.session.get(CrawlState, board)
+        if state and state.watermark:
+            return state.watermark
+        return (
+            db.session.query(db.func.max(Post.last_updated))
+            .filter(Post.post_type == board_post_type(board))
+            .scalar()
         )
-        comments_to_insert = []
-        number = last_page_count
-        stop_processing = False
 
-        while number >= 0 and not stop_processing:
-            print(f"Begin Comment Scraping .{number}")
 
-            reversed_comments = scrape_page_comments(topic_id, number)[::-1]
+def save_crawl_state(board, watermark, board_offset):
+    statement = insert(CrawlState).values(
+        board=board,
+        watermark=watermark,
+        board_offset=board_offset,
+        updated_at=datetime.utcnow(),
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[CrawlState.board],
+        set_={
+            "watermark": statement.excluded.watermark,
+            "board_offset": statement.excluded.board_offset,
+            "updated_at": statement.excluded.updated_at,
+        },
+    )
+    try:
+        with timed("db_write"):
+            db.session.execute(statement)
+            db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"Error saving crawl state for board {board}: {e}")
+        raise
 
-            for comment in reversed_comments:
-                print(f"checking reply #{comment['number']}")
-                if queried_comment and comment["number"] == queried_comment.number:
-                    print("FOUND COMMENT MATCH")
+
+def crawl_board(board, limit=None, workers=None, delta=False, progress=None):
+    """
+    Walk a board from its first page, storing changed posts and their new comments
+    Full mode stops at the first post whose last_updated already matches the database
+    Delta mode walks pages only until rows drop below the board's watermark, then commits
+    the new watermark once every newer row has been processed
+    progress, when given, is told about every page, post and comment processed
+    """
+    with labelled(board=board_post_type(board)):
+        watermark = get_watermark(board) if delta else None
+        newest = watermark
+        stop_processing = False
+        count = 0
+        while not stop_processing:
+            print(f"Begin scraping .{count} (page {(count // 50) + 1})")
+            current_url = board_url(board, count)
+            page_small_data = get_page_posts_small_data(current_url)
+            index_board_page(page_small_data, board, count)
+            if progress is not None:
+                progress.add(pages=1)
+            if not page_small_data:
+                print("STOPPING because the board has no more posts")
+                break
+
+            if watermark is not None:
+                unseen = [
+                    small_post_data
+                    for small_post_data in page_small_data
+                    if small_post_data["last_updated"] >= watermark
+                ]
+                if len(unseen) < len(page_small_data):
+                    print(
+                        "STOPPING after this page because the watermark has been reached"
+                    )
                     stop_processing = True
-                    break
-                else:
-                    print("adding reply ^")
-                    new_db_comment = Comment(
-                        comment_id=comment["comment_id"],
-                        post_topic_id=topic_id,
-                        number=comment["number"],
-                        link=comment["link"],
-                        commenter=comment["commenter"],
-                        message=comment["message"],
-                        is_starter=comment["is_starter"],
-                        attachment=comment["attachment"],
-                        created_at=comment["created_at"],
+                page_small_data = unseen
+            if limit is not None:
+                page_small_data = page_small_data[: limit - count]
+
+            # changed and unchanged topics are told apart before any topic page is fetched
+            stored = prefetch_board_page(page_small_data)
+            changed_small_data = []
+            for idx, small_post_data in enumerate(page_small_data):
+                topic_id = small_post_data["topic_id"]
+                if newest is None or small_post_data["last_updated"] > newest:
+                    newest = small_post_data["last_updated"]
+                known = stored.get(topic_id)
+                if known and known["last_updated"] == small_post_data["last_updated"]:
+                    print(
+                        f"post: {topic_id} -- {(count // 50) + 1}.{idx + 1} FOUND POST MATCH"
                     )
-                    comments_to_insert.append(new_db_comment)
-            number -= 50
-        else:
-            # print("Ended up scraping all comments")
-            pass
-
-        if comments_to_insert:
-            print("Bulk Saving Comments to Database")
-            db.session.bulk_save_objects(comments_to_insert)
-            db.session.commit()
-    except Exception as e:
-        raise
+                    if limit is None and not delta:
+                        print("STOPPING")
+                        stop_processing = True
+                        break
+                    continue
+                changed_small_data.append(small_post_data)
+
+            # topic pages are fetched in parallel and come back in board order
+            urls = [small_post_data["url"] for small_post_data in changed_small_data]
+            body_hashes = {
+                small_post_data["url"]: stored[small_post_data["topic_id"]]["body_hash"]
+                for small_post_data in changed_small_data
+                if small_post_data["topic_id"] in stored
+            }
+            page_post_data = get_posts_data(
+                urls, max_workers=workers, body_hashes=body_hashes
+            )
+            page_all_data = [
+                get_all_post_data(small_post_data, post_data)
+                for small_post_data, post_data in zip(
+                    changed_small_data, page_post_data
+                )
+            ]
+            # every post and image of the page is written in one transaction
+            upsert_posts(page_all_data)
+
+            for all_post_data in page_all_data:
+                topic_id = all_post_data["topic_id"]
+                print(f"post: {topic_id} added or updated")
+                known = stored.get(topic_id, {})
+                with labelled(topic=topic_id):
+                    new_comments = process_post_comments(
+                        topic_id, latest_number=known.get("latest_comment", 0)
+                    )
+                if progress is not None:
+                    progress.add(posts=1, comments=new_comments)
+                print("------")
+
+            if limit is not None and count + len(page_small_data) >= limit:
+                print("STOPPING because limit has been reached")
+                stop_processing = True
+
+            print(f"Finished scraping .{count} (page {(count // 50) + 1})\n")
+            if not stop_processing:
+                count += 50
+
+        # a limited crawl leaves older changed rows behind, so only a complete delta sync moves the watermark
+        if delta and limit is None and newest is not None:
+            save_crawl_state(board, newest, count)
+
+
+def save_crawl_run(kind, key, crawl, status, job_id=None):
+    """
+    Store the timing summary of a finished crawl and publish this process's metrics
+    Goes through its own connection so a crawl that failed mid-transaction can still be recorded
+    """
+    summary = crawl.summary()
+    print(
+        f"Crawl {kind} {key or ''} {status} in {summary['seconds']:.1f}s: "
+        f"{summary['stages']}"
+    )
+    write_snapshot()
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(
+                insert(CrawlRun).values(
+                    kind=kind,
+                    key=None if key is None else str(key),
+                    job_id=job_id,
+                    status=status,
+                    started_at=datetime.utcfromtimestamp(crawl.started),
+                    finished_at=datetime.utcnow(),
+                    summary=summary,
+                )
+            )
+    except SQLAlchemyError as e:
+        print(f"Error saving crawl summary: {e}")
 
 
 def populate_helper(post_type, url):
@@ -0,0 +1,87 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from src.bench import corpus
+from src.bench.server import start_server
+from src.scrape import imgur, ratelimit
+from src.scrape.posts import parse_post_data
+
+ALBUM_URL = "https://imgur.com/a/kEyCaPs"
+ALBUM_HASH = "kEyCaPs"
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    # the bench stand-in serves the imgur album api, latency keeps concurrent requests overlapping
+    server = start_server(latency=0.2)
+    monkeypatch.setattr(imgur, "IMGUR_API_URL", f"{server.url}/3")
+    monkeypatch.setattr(imgur, "IMGUR_CACHE_DIR", str(tmp_path / "imgur"))
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_DIR", str(tmp_path / "ratelimit"))
+    monkeypatch.setattr(ratelimit, "RATE", 1000.0)
+    monkeypatch.setattr(ratelimit, "BURST", 1000.0)
+    monkeypatch.setenv("IMGUR_CLIENT_ID", "test")
+    yield server
+    server.shutdown()
+
+
+def test_concurrent_expansions_hit_the_api_once(stub):
+    futures = []
+    lock = threading.Lock()
+
+    def expand():
+        future = imgur.expand_album(ALBUM_URL)
+        with lock:
+            futures.append(future)
+
+    threads = [threading.Thread(target=expand) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    results = [future.result(timeout=10) for future in futures]
+    assert results[0]
+    assert all(result == results[0] for result in results)
+    assert stub.album_requests == {ALBUM_HASH: 1}
+
+    # once expanded the album is served from the disk cache
+    assert imgur.expand_album(ALBUM_URL).result(timeout=10) == results[0]
+    assert stub.album_requests == {ALBUM_HASH: 1}
+
+
+def test_expired_cache_entry_is_fetched_again(stub):
+    images = imgur.scrape_imgur(ALBUM_URL)
+    assert imgur.scrape_imgur(ALBUM_URL) == images
+    assert stub.album_requests == {ALBUM_HASH: 1}
+
+    path = os.path.join(imgur.IMGUR_CACHE_DIR, f"{ALBUM_HASH}.json")
+    with open(path) as f:
+        cached = json.load(f)
+    cached["fetched_at"] = time.time() - imgur.IMGUR_CACHE_TTL - 1
+    with open(path, "w") as f:
+        json.dump(cached, f)
+
+    assert imgur.scrape_imgur(ALBUM_URL) == images
+    assert stub.album_requests == {ALBUM_HASH: 2}
+
+
+def test_failed_album_leaves_the_post_unhashed(stub):
+    with open(os.path.join(FIXTURES, "topic_200169_0.html"), "rb") as f:
+        markup = f.read()
+    stub.error_rate = 1.0
+    stub.error_status = 404
+
+    data = parse_post_data(markup)
+    assert data["body_hash"] is None
+    # nothing is cached for the failed album, the next crawl asks the api again
+    assert not os.path.exists(os.path.join(imgur.IMGUR_CACHE_DIR, "alb9.json"))
+
+    stub.error_rate = 0.0
+    data = parse_post_data(markup)
+    assert data["body_hash"] is not None
+    assert set(corpus.album_images("alb9")) <= set(data["images"])
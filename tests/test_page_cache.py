@@ -0,0 +1,74 @@
+import pytest
+
+from src.bench.server import start_server
+from src.scrape import cache, client, ratelimit
+from src.scrape.comments import (
+    get_last_page_count,
+    scrape_for_specific_comment,
+    scrape_page_comments,
+    scrape_pages_comments,
+)
+from src.scrape.crawl import crawl_scope
+from src.scrape.posts import get_post_data
+
+# a deep synthetic thread, so its first page is followed by full pages
+TOPIC_ID = 200169
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    server = start_server()
+    monkeypatch.setattr(client, "GEEKHACK_URL", server.url)
+    monkeypatch.setattr(cache, "CACHE_ENABLED", True)
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(cache, "TOPIC_TTL", 0)
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_DIR", str(tmp_path / "ratelimit"))
+    monkeypatch.setattr(ratelimit, "RATE", 1000.0)
+    monkeypatch.setattr(ratelimit, "BURST", 1000.0)
+    monkeypatch.setenv("IMGUR_CLIENT_ID", "test")
+    yield server
+    server.shutdown()
+
+
+def test_full_comment_pages_are_served_from_the_cache(stub):
+    scrape_page_comments(TOPIC_ID, 50, final=True)
+    served = stub.served
+    scrape_page_comments(TOPIC_ID, 50, final=True)
+    assert stub.served == served
+
+
+def test_first_page_is_revalidated_after_a_final_fetch(stub):
+    scrape_page_comments(TOPIC_ID, 0, final=True)
+    scrape_page_comments(TOPIC_ID, 50, final=True)
+
+    served = stub.served
+    get_last_page_count(TOPIC_ID)
+    assert stub.served == served + 1
+    # a caller that does not know the page is final is not served the final entry
+    scrape_page_comments(TOPIC_ID, 50)
+    assert stub.served == served + 2
+    get_post_data(f"https://geekhack.org/index.php?topic={TOPIC_ID}.0")
+    assert stub.served > served + 2
+
+
+def test_replies_past_the_last_page_are_not_fetched(stub):
+    with crawl_scope() as crawl:
+        last_page_count = get_last_page_count(TOPIC_ID)
+        comments = scrape_page_comments(TOPIC_ID, last_page_count)
+        assert crawl.topic(TOPIC_ID)["replies"] == comments[-1]["number"]
+
+        served = stub.served
+        assert scrape_for_specific_comment(TOPIC_ID, comments[-1]["number"] + 1) is None
+        assert stub.served == served
+
+
+def test_pages_are_fetched_through_the_given_session(stub):
+    session = client.create_session()
+    urls = []
+    session.hooks["response"].append(
+        lambda response, **kwargs: urls.append(response.url)
+    )
+
+    comments = scrape_pages_comments(TOPIC_ID, [50, 100], session=session)
+    assert [len(page) for page in comments] == [50, 50]
+    assert len(urls) == 2
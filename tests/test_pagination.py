@@ -0,0 +1,74 @@
+import base64
+import json
+from datetime import datetime
+
+import pytest
+
+from src.extensions import db
+from src.models import Comment, Post
+from src.pagination import decode_cursor, encode_cursor
+
+LATEST = [Post.last_updated, Post.topic_id]
+RANKED = [db.cast(db.literal(0.5), db.Float), Post.topic_id]
+
+
+def raw_cursor(payload):
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+
+def test_round_trip():
+    last_updated = datetime(2024, 6, 1, 12, 30, 5)
+    cursor = encode_cursor("next", [last_updated, 200169])
+    assert decode_cursor(cursor, LATEST) == ("next", [last_updated, 200169])
+    assert decode_cursor(encode_cursor("prev", [0.25, 7]), RANKED) == (
+        "prev",
+        [0.25, 7],
+    )
+    # a rank of exactly 0 is written as an int
+    assert decode_cursor(raw_cursor(["next", [0, 7]]), RANKED) == ("next", [0.0, 7])
+
+
+@pytest.mark.parametrize(
+    "cursor, key_columns",
+    [
+        ("not base64 !", LATEST),
+        (base64.urlsafe_b64encode(b"not json").decode(), LATEST),
+        (raw_cursor({"next": 1, "prev": 2}), LATEST),
+        (raw_cursor(["next"]), LATEST),
+        (raw_cursor(["sideways", ["2024-06-01T12:00:00", 1]]), LATEST),
+        (raw_cursor(["next", {"a": 1, "b": 2}]), LATEST),
+        (raw_cursor(["next", "ab"]), LATEST),
+        (raw_cursor(["next", ["2024-06-01T12:00:00"]]), LATEST),
+        (raw_cursor(["next", [1717243200, 1]]), LATEST),
+        (raw_cursor(["next", ["yesterday", 1]]), LATEST),
+        (raw_cursor(["next", ["2024-06-01T12:00:00+02:00", 1]]), LATEST),
+        (raw_cursor(["next", ["2024-06-01T12:00:00", "1"]]), LATEST),
+        (raw_cursor(["next", ["2024-06-01T12:00:00", 1.5]]), LATEST),
+        (raw_cursor(["next", ["2024-06-01T12:00:00", True]]), LATEST),
+        (raw_cursor(["next", ["2024-06-01T12:00:00", 2**40]]), LATEST),
+        (raw_cursor(["next", [True, 1]]), RANKED),
+        (raw_cursor(["next", ["0.5", 1]]), RANKED),
+        (raw_cursor(["next", [None, 1]]), RANKED),
+        ("WyJuZXh0IixbTmFOLDFdXQ", RANKED),
+    ],
+)
+def test_invalid_cursors_raise_value_error(cursor, key_columns):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, key_columns)
+
+
+@pytest.mark.parametrize(
+    "number, sort, last_number, page",
+    [
+        (0, "asc", 100, 1),
+        (49, "asc", 100, 1),
+        (50, "asc", 100, 2),
+        (100, "desc", 100, 1),
+        (51, "desc", 100, 1),
+        (50, "desc", 100, 2),
+        (0, "desc", 100, 3),
+        (0, "desc", 0, 1),
+    ],
+)
+def test_page_of(number, sort, last_number, page):
+    assert Comment.page_of(number, 50, sort, last_number) == page
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from src.scrape.comments import parse_page_comments
+from src.scrape.parser import PAGE_LINKS, available_backends, make_soup
+from src.scrape.posts import parse_page_posts_small_data
+
+# saved smf pages (from the bench stand-in corpus) with nested quotes, attachments and page links
+# the corpus is well formed, so this only guards the scrapers against backend specific tree shapes;
+# it is no evidence for switching SCRAPE_PARSER away from html5lib on real, messier pages
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+REFERENCE = "html5lib"
+BACKENDS = [backend for backend in available_backends() if backend != REFERENCE]
+BOARD_URL = "https://geekhack.org/index.php?board=132.0"
+TOPIC_PAGES = ["topic_200169_0.html", "topic_200169_50.html", "topic_200169_1450.html"]
+
+pytestmark = pytest.mark.skipif(
+    REFERENCE not in available_backends(), reason="html5lib is the reference backend"
+)
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+def topic_page_args(name):
+    _, topic_id, count = os.path.splitext(name)[0].split("_")
+    return int(topic_id), int(count)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("name", TOPIC_PAGES)
+def test_comment_pages_match_reference(backend, name):
+    markup = read_fixture(name)
+    topic_id, count = topic_page_args(name)
+
+    expected = parse_page_comments(markup, topic_id, count, backend=REFERENCE)
+    assert expected
+    assert parse_page_comments(markup, topic_id, count, backend=backend) == expected
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_board_page_matches_reference(backend):
+    markup = read_fixture("board_132_0.html")
+
+    expected = parse_page_posts_small_data(markup, BOARD_URL, backend=REFERENCE)
+    assert len(expected) == 50
+    assert parse_page_posts_small_data(markup, BOARD_URL, backend=backend) == expected
+
+
+@pytest.mark.parametrize("backend", available_backends())
+@pytest.mark.parametrize("name", ["board_132_0.html", "topic_200169_50.html"])
+def test_page_links_strainer_keeps_multi_class_div(backend, name):
+    soup = make_soup(read_fixture(name), only=PAGE_LINKS, backend=backend)
+
+    page_links = soup.find("div", class_="pagelinks floatleft")
+    assert page_links is not None
+    assert page_links.find_all("a", class_="navPages")